@@ -1,4 +1,4 @@
-#!/usr/bin/python
+#!/usr/bin/env python3
 #
 # PacketSled Intel Pre Processor for Bro in PacketSled
 #
@@ -6,37 +6,148 @@
 # 10-07-2015    Initial development                                     Aaron Eppert
 # 08-02-2017    Adding functionality                                    Aaron Eppert
 
+import io
 import os
-import re
 import sys
-import string
-from optparse import OptionParser
+import time
+import struct
+from _thread import _local
 
+
+##
+# Stand-in for a module, or for a name imported from one, that is imported on
+# first use and then takes its own place in this module's namespace, so later
+# uses cost nothing. Keeps runs that never get to verify entries, such as a
+# header check, from paying for the regular expression, compression,
+# multiprocessing and socket modules. LAZY_MODULES lists every module
+# imported this way.
+##
+LAZY_MODULES = []
+
+
+class _lazy_import:
+    def __init__(self, module, name=None):
+        self.__module = module
+        self.__name = name
+        LAZY_MODULES.append(module)
+
+    def __load(self):
+        __import__(self.__module)
+        value = sys.modules[self.__module]
+        if self.__name is not None:
+            value = getattr(value, self.__name)
+        globals()[self.__name or self.__module] = value
+        return value
+
+    def __getattr__(self, attr):
+        return getattr(self.__load(), attr)
+
+    def __call__(self, *args, **kwargs):
+        return self.__load()(*args, **kwargs)
+
+
+re = _lazy_import('re')
+bz2 = _lazy_import('bz2')
+copy = _lazy_import('copy')
+gzip = _lazy_import('gzip')
+heapq = _lazy_import('heapq')
+mmap = _lazy_import('mmap')
+shutil = _lazy_import('shutil')
+tempfile = _lazy_import('tempfile')
+threading = _lazy_import('threading')
+zlib = _lazy_import('zlib')
+socket = _lazy_import('socket')
+bisect = _lazy_import('bisect')
+collections = _lazy_import('collections')
+itertools = _lazy_import('itertools')
+signal = _lazy_import('signal')
+hashlib = _lazy_import('hashlib')
+binascii = _lazy_import('binascii')
+json = _lazy_import('json')
+multiprocessing = _lazy_import('multiprocessing')
+queue = _lazy_import('queue')
+socketserver = _lazy_import('socketserver')
+array = _lazy_import('array', 'array')
+
+#
+# Where diagnostics go, kept per thread so that concurrent verifications in
+# the daemon do not mix their output.
+#
+# capture   - When set to a list, diagnostics are recorded as (line, message,
+#             detail) tuples instead of being written to stderr. Worker
+#             processes use this so the parent can replay their output in
+#             feed order with the correct line numbers.
+# collector - When set to a bro_intel_diagnostics, line diagnostics are
+#             handed to it instead of being written to stderr.
+# count     - Number of diagnostics emitted or captured so far
+#
+class _diagnostic_state(_local):
+    capture = None
+    collector = None
+    count = 0
+
+_diagnostics = _diagnostic_state()
+
+##
+# Escape a single character for display. Accepts a one character string or,
+# when iterating over bytes, the integer value of the byte.
+##
 def escape(c):
-    if ord(c) > 31 and ord(c) < 127:
-        return c
-    c = ord(c)
+    if not isinstance(c, int):
+        c = ord(c)
+    if c > 31 and c < 127:
+        return chr(c)
     if c <= 0xff:
         return r'\x{0:02x}'.format(c)
-    elif c <= r'\uffff':
+    elif c <= 0xffff:
         return r'\u{0:04x}'.format(c)
     else:
         return r'\U{0:08x}'.format(c)
 
 
 def hex_escape(s):
+    if not isinstance(s, bytes):
+        s = as_bytes(s)
     return ''.join(escape(c) for c in s)
 
 
+##
+# Feed data is handled as bytes from end to end. Where it is shown in a
+# message it is decoded as UTF-8 with undecodable bytes kept as surrogate
+# escapes, and as_bytes() and stderr turn those back into the original bytes.
+##
+def as_text(t):
+    if isinstance(t, bytes):
+        return t.decode('utf-8', 'surrogateescape')
+    return t
+
+
+def as_bytes(t):
+    if isinstance(t, bytes):
+        return t
+    return t.encode('utf-8', 'surrogateescape')
+
+
 def write_stderr(msg):
+    _diagnostics.count += 1
+    if _diagnostics.capture is not None:
+        _diagnostics.capture.append((None, msg, None))
+        return
     sys.stderr.write(msg + '\n')
 
 
 def warning_line(line, *objs):
-    out = 'WARNING: Line %d - ' % (int(line)+1)
-    for o in objs:
-        out += o
-    write_stderr(out)
+    report_line(line, ''.join(objs))
+
+
+def replay_diagnostics(diagnostics, offset=0):
+    for line, msg, detail in diagnostics:
+        if line is None:
+            write_stderr(msg)
+        elif detail is None:
+            warning_line(offset + line, msg)
+        else:
+            report_line(offset + line, msg, *detail)
 
 
 class bro_intel_indicator_return:
@@ -45,6 +156,566 @@ class bro_intel_indicator_return:
     ERROR   = 2
 
 
+##
+# Report a diagnostic for a feed line. level is a bro_intel_indicator_return
+# code; code, column and value are only used by the structured output.
+##
+def report_line(line, msg, level=bro_intel_indicator_return.WARNING,
+                code=None, column=None, value=None):
+    _diagnostics.count += 1
+    if _diagnostics.capture is not None:
+        _diagnostics.capture.append((int(line), msg, (level, code, column, value)))
+    elif _diagnostics.collector is not None:
+        _diagnostics.collector.add(int(line), msg, level, code, column, value)
+    else:
+        sys.stderr.write('WARNING: Line %d - %s\n' % (int(line)+1, msg))
+
+
+###############################################################################
+# class bro_intel_profile
+#
+# Opt-in profiling counters. Each counter is keyed by (kind, name), where kind
+# is 'stage' for the pipeline stages (read, split, separator, write), 'verifier'
+# for the column verifiers and 'handler' for the indicator type handlers, and
+# holds [calls, seconds, failures]. Functions are profiled by wrapping them
+# once, so nothing is paid for when profiling is off. Counters from worker
+# processes are handed back with take() and folded in with merge().
+#
+_clock = time.perf_counter
+
+
+class bro_intel_profile:
+    formats = ['table', 'prometheus']
+
+    def __init__(self):
+        self.counters = {}
+
+    def __counter(self, kind, name):
+        return self.counters.setdefault((kind, name), [0, 0.0, 0])
+
+    def add(self, kind, name, seconds, calls=1, failures=0):
+        c = self.__counter(kind, name)
+        c[0] += calls
+        c[1] += seconds
+        c[2] += failures
+
+    ##
+    # Wrap a function of any signature. failed, if given, is called with the
+    # result and decides whether the call counts as a failure.
+    ##
+    def wrap(self, kind, name, func, failed=None):
+        c = self.__counter(kind, name)
+
+        def profiled(*args, **kwargs):
+            start = _clock()
+            r = func(*args, **kwargs)
+            c[1] += _clock() - start
+            c[0] += 1
+            if failed is not None and failed(r):
+                c[2] += 1
+            return r
+        return profiled
+
+    ##
+    # Wrap a verifier or handler, a function of one value returning a
+    # (bro_intel_indicator_return, message) tuple. The original is kept as
+    # .func and the counter name as .name.
+    ##
+    def wrap_verifier(self, kind, name, func):
+        OKAY = bro_intel_indicator_return.OKAY
+        c = self.__counter(kind, name)
+
+        def profiled(t):
+            start = _clock()
+            r = func(t)
+            c[1] += _clock() - start
+            c[0] += 1
+            if r[0] != OKAY:
+                c[2] += 1
+            return r
+        profiled.func = func
+        profiled.name = name
+        return profiled
+
+    ##
+    # Wrap a bro_intel_column_verifier kernel; every cell of the column
+    # counts as a call.
+    ##
+    def wrap_kernel(self, kind, name, kernel):
+        OKAY = bro_intel_indicator_return.OKAY
+        c = self.__counter(kind, name)
+
+        def profiled(column):
+            start = _clock()
+            r = kernel(column)
+            c[1] += _clock() - start
+            c[0] += len(column)
+            c[2] += sum(1 for i, code, d in r if code != OKAY)
+            return r
+        return profiled
+
+    def take(self):
+        counters = dict((k, list(c)) for k, c in self.counters.items() if c[0])
+        for c in self.counters.values():
+            c[:] = [0, 0.0, 0]
+        return counters
+
+    def merge(self, counters):
+        for (kind, name), (calls, seconds, failures) in counters.items():
+            self.add(kind, name, seconds, calls, failures)
+
+    def __rows(self):
+        return sorted(((kind, name, c) for (kind, name), c in self.counters.items() if c[0]),
+                      key=lambda r: (-r[2][1], r[0], r[1]))
+
+    def format_table(self):
+        out = ['%-10s %-24s %12s %10s %10s %7s' %
+               ('kind', 'name', 'calls', 'seconds', 'us/call', 'fail%')]
+        for kind, name, (calls, seconds, failures) in self.__rows():
+            out.append('%-10s %-24s %12d %10.3f %10.2f %7.2f' %
+                       (kind, name, calls, seconds, seconds * 1e6 / calls,
+                        failures * 100.0 / calls))
+        return '\n'.join(out) + '\n'
+
+    def format_prometheus(self):
+        out = []
+        for metric, i, help_text in (('pipp_calls_total', 0, 'Number of calls'),
+                                     ('pipp_seconds_total', 1, 'Cumulative time spent, in seconds'),
+                                     ('pipp_failures_total', 2, 'Number of calls that did not pass')):
+            out.append('# HELP %s %s' % (metric, help_text))
+            out.append('# TYPE %s counter' % (metric))
+            for kind, name, c in self.__rows():
+                out.append('%s{kind="%s",name="%s"} %s' %
+                           (metric, kind, name.replace('\\', '\\\\').replace('"', '\\"'), repr(c[i])))
+        return '\n'.join(out) + '\n'
+
+    def report(self, out, fmt='table'):
+        if fmt == 'prometheus':
+            out.write(self.format_prometheus())
+        else:
+            out.write(self.format_table())
+
+
+class bro_intel_diagnostic_code:
+    HEADER          = 'header'
+    FIELD_COUNT     = 'field_count'
+    FIELD_SEPARATOR = 'field_separator'
+    EMPTY_FIELD     = 'empty_field'
+    INVALID_VALUE   = 'invalid_value'
+    UNPRINTABLE     = 'unprintable'
+    CORRELATION     = 'correlation'
+    DUPLICATE       = 'duplicate'
+    CONFLICT        = 'conflict'
+    OVERLAP         = 'overlap'
+    ALLOWLISTED     = 'allowlisted'
+
+
+###############################################################################
+# class bro_intel_diagnostics
+#
+# Machine readable diagnostics. Every line diagnostic is written to out as a
+# JSON object on a line of its own, in batches of batch_size, and counted per
+# column and code. Once max_errors errors have been recorded everything after
+# them is dropped and capped is set. close() writes a final summary object,
+# which also gives the number of entries left out as allowlisted.
+#
+class bro_intel_diagnostics:
+    LEVELS = {bro_intel_indicator_return.OKAY:    'okay',
+              bro_intel_indicator_return.WARNING: 'warning',
+              bro_intel_indicator_return.ERROR:   'error'}
+
+    def __init__(self, out, max_errors=None, batch_size=1000):
+        self.__out = out
+        self.__batch = []
+        self.batch_size = batch_size
+        self.max_errors = max_errors
+        self.errors = 0
+        self.warnings = 0
+        self.capped = False
+        self.histogram = {}
+        self.allowlisted_dropped = 0
+
+    def add(self, line, msg, level, code, column, value):
+        if self.capped:
+            return
+        if level == bro_intel_indicator_return.ERROR:
+            self.errors += 1
+            if self.max_errors is not None and self.errors >= self.max_errors:
+                self.capped = True
+        else:
+            self.warnings += 1
+
+        key = (column, code)
+        self.histogram[key] = self.histogram.get(key, 0) + 1
+
+        if value is not None:
+            value = hex_escape(value)
+        self.__batch.append(json.dumps({'line': line + 1,
+                                        'column': column,
+                                        'level': self.LEVELS.get(level, level),
+                                        'code': code,
+                                        'value': value,
+                                        'message': hex_escape(msg)},
+                                       sort_keys=True))
+        if len(self.__batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.__batch:
+            data = '\n'.join(self.__batch) + '\n'
+            if not isinstance(self.__out, io.TextIOBase):
+                data = data.encode('ascii')
+            self.__out.write(data)
+            self.__batch = []
+        self.__out.flush()
+
+    def summary(self):
+        return {'errors': self.errors,
+                'warnings': self.warnings,
+                'capped': self.capped,
+                'allowlisted_dropped': self.allowlisted_dropped,
+                'histogram': [{'column': column, 'code': code, 'count': count}
+                              for (column, code), count in sorted(self.histogram.items(),
+                                                                  key=self.__histogram_order)]}
+
+    # Diagnostics without a column or code sort first
+    @staticmethod
+    def __histogram_order(item):
+        (column, code), count = item
+        return (column is not None, column or '', code is not None, code or '')
+
+    def close(self):
+        self.__batch.append(json.dumps({'summary': self.summary()}, sort_keys=True))
+        self.flush()
+
+
+###############################################################################
+# Patterns
+#
+# The printable check needs no regular expression: deleting every printable
+# ASCII byte leaves nothing. EMAIL_RX is compiled on first use, once.
+#
+PRINTABLE_BYTES = bytes(range(0x20, 0x7f))
+
+
+class _lazy_pattern:
+    def __init__(self, pattern):
+        self.pattern = pattern
+
+    def __getattr__(self, attr):
+        value = getattr(re.compile(self.pattern), attr)
+        setattr(self, attr, value)
+        return value
+
+
+EMAIL_RX = _lazy_pattern(br"(^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$)")
+
+
+##
+# ASCII printable check. Bytes are checked as they are, without decoding.
+##
+def is_printable(t):
+    if not isinstance(t, bytes):
+        t = as_bytes(t)
+    return not t.translate(None, PRINTABLE_BYTES)
+
+
+##
+# Tokenize a feed row in one pass. Returns the fields, the number of tab
+# separators and the positions of fields holding only a space. The space scan
+# is skipped unless the fields contain one at all.
+##
+def tokenize_row(l):
+    fields = l.split(b'\t')
+    if b' ' in fields:
+        spaces = [i for i, x in enumerate(fields) if x == b' ']
+    else:
+        spaces = ()
+    return fields, len(fields) - 1, spaces
+
+
+###############################################################################
+# Address parsing
+#
+# Addresses are parsed with inet_pton(), a strict single pass parser that,
+# unlike inet_aton(), rejects short forms such as "10.1" and leading zeros,
+# and are handled as (version, integer) pairs. Networks are handled as
+# (version, prefix length, prefix) where prefix holds only the network bits.
+#
+ADDRESS_BITS = {4: 32, 6: 128}
+
+
+def parse_address(s):
+    try:
+        s = s.decode('ascii')
+    except UnicodeError:
+        return None
+    try:
+        return 4, struct.unpack('!I', socket.inet_pton(socket.AF_INET, s))[0]
+    except (socket.error, ValueError, TypeError):
+        pass
+    if ':' in s:
+        try:
+            return 6, int(binascii.hexlify(socket.inet_pton(socket.AF_INET6, s)), 16)
+        except (socket.error, ValueError, TypeError):
+            pass
+    return None
+
+
+def parse_network(s):
+    addr, sep, plen = s.partition(b'/')
+    if not sep or not plen.isdigit() or len(plen) > 3:
+        return None
+    a = parse_address(addr)
+    if a is None:
+        return None
+    version, value = a
+    plen = int(plen)
+    if plen > ADDRESS_BITS[version]:
+        return None
+    return version, plen, value >> (ADDRESS_BITS[version] - plen)
+
+
+def format_address(version, value):
+    if version == 4:
+        return socket.inet_ntop(socket.AF_INET, struct.pack('!I', value))
+    return socket.inet_ntop(socket.AF_INET6, binascii.unhexlify('%032x' % value))
+
+
+def format_network(version, plen, prefix):
+    return '%s/%d' % (format_address(version, prefix << (ADDRESS_BITS[version] - plen)), plen)
+
+
+###############################################################################
+# Domain names and URLs
+#
+# Hand-written scanners in place of regular expressions. The character set
+# is checked over the whole name with one str.translate(), the name is split
+# on dots once and the label rules are then checked with substring tests, so
+# the work is linear in the length of the input whatever it holds.
+#
+# A domain name is 4 to 253 characters of dot separated labels. Every label
+# but the last is 1 to 63 letters, digits and hyphens, and does not start or
+# end with a hyphen. The last is a top level domain of 2 to 63 letters, or
+# an IDNA ("xn--") label so that normalized internationalized names pass.
+#
+# A URL, as Bro expects it, has no scheme and is a host (domain name with an
+# optional trailing dot, localhost, IPv4 address or bracketed IPv6 address),
+# an optional port and an optional path or query without whitespace.
+#
+DOMAIN_NAME_CHARS = b'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789-.'
+URI_SCHEMES = (b'http://', b'https://')
+
+
+def scan_domain(name):
+    if not 4 <= len(name) <= 253 or name.translate(None, DOMAIN_NAME_CHARS):
+        return False
+    labels = name.split(b'.')
+    tld = labels[-1]
+    if len(labels) < 2 or not 2 <= len(tld) <= 63 or b'' in labels:
+        return False
+    if not tld.isalpha() and (tld[:4].lower() != b'xn--' or tld[-1:] == b'-'):
+        return False
+    if name[:1] == b'-' or b'-.' in name or b'.-' in name:
+        return False
+    return len(name) <= 63 or max(map(len, labels)) <= 63
+
+
+##
+# Split a URL into its host, port (None if there is none) and everything
+# after them. The host of a bracketed IPv6 address keeps its brackets.
+##
+def split_url(url):
+    i = url.find(b'/')
+    j = url.find(b'?')
+    if j >= 0 and (i < 0 or j < i):
+        i = j
+    if i < 0:
+        hostport, rest = url, b''
+    else:
+        hostport, rest = url[:i], url[i:]
+
+    if hostport[:1] == b'[':
+        end = hostport.find(b']') + 1 or len(hostport)
+        host, port = hostport[:end], hostport[end:]
+        if port[:1] == b':':
+            return host, port[1:], rest
+        return host, port or None, rest
+    host, sep, port = hostport.partition(b':')
+    return host, port if sep else None, rest
+
+
+def scan_url(url):
+    host, port, rest = split_url(url)
+    if host[:1] == b'[':
+        a = parse_address(host[1:-1]) if host[-1:] == b']' else None
+        if a is None or a[0] != 6:
+            return False
+    elif host[-1:].isdigit():
+        a = parse_address(host)
+        if a is None or a[0] != 4:
+            return False
+    elif host.lower() != b'localhost':
+        if host.endswith(b'.'):
+            host = host[:-1]
+        if not scan_domain(host):
+            return False
+
+    if port is not None and (not port.isdigit() or len(port) > 5 or int(port) > 65535):
+        return False
+
+    return rest in (b'', b'/') or (len(rest) > 1 and rest.split() == [rest])
+
+
+##
+# Normal form of a domain name: one trailing dot removed, internationalized
+# names converted to IDNA punycode and everything lowercased. Names that can
+# not be converted are returned as they are, for verification to report.
+##
+def normalize_domain(name):
+    if name.endswith(b'.'):
+        name = name[:-1]
+    try:
+        name.decode('ascii')
+    except UnicodeError:
+        try:
+            name = name.decode('utf-8').encode('idna')
+        except UnicodeError:
+            return name
+    return name.lower()
+
+
+def normalize_url(url):
+    host, port, rest = split_url(url)
+    port = b':' + port if port is not None else b''
+    if host[:1] == b'[':
+        return host.lower() + port + rest
+    return normalize_domain(host) + port + rest
+
+
+###############################################################################
+# Hashes and certificate fingerprints
+#
+# Hashes are hex digests of one of the lengths in HASH_LENGTHS. Hex digits are
+# checked with a str.translate() deletion table, which runs in C and can be
+# applied to a whole column joined together. Certificate hashes may also be
+# written as colon separated fingerprints (AB:CD:...), as openssl prints
+# them; Bro itself sees plain lowercase hex, which is what normalize_hash()
+# produces.
+#
+HEX_DIGITS = b'0123456789abcdefABCDEF'
+HASH_LENGTHS = {32: 'md5',
+                40: 'sha1',
+                64: 'sha256',
+                128: 'sha512'}
+
+
+def is_hex(t):
+    return not t.translate(None, HEX_DIGITS)
+
+
+##
+# Returns the hex digits of a fingerprint with the colons between byte pairs
+# removed, t itself if it has no colons, or None if the colons are misplaced.
+##
+def fingerprint_hex(t):
+    if b':' not in t:
+        return t
+    h = t.replace(b':', b'')
+    if len(h) * 3 != (len(t) + 1) * 2 or t[2::3].strip(b':'):
+        return None
+    return h
+
+
+def normalize_hash(t):
+    h = fingerprint_hex(t)
+    return (t if h is None else h).lower()
+
+
+###############################################################################
+# class bro_intel_public_suffixes
+#
+# Public suffix list (https://publicsuffix.org/list/) held as a trie of
+# reversed labels, "co.uk" being found under "uk" then "co". A node is a dict
+# of label to child. A child without children of its own is stored as just
+# its rule flag, and a node that is also a rule holds its flag under the empty
+# label, which no domain name can contain. Rules are converted to IDNA so
+# they match the ASCII names found in feeds.
+#
+class bro_intel_public_suffixes:
+    RULE = 1
+    EXCEPTION = 2
+
+    def __init__(self, path):
+        self.path = path
+        self.rules = 0
+        self.__root = {}
+        with open(path, 'rb') as f:
+            for l in f:
+                t = l.split()
+                if t and not t[0].startswith(b'//'):
+                    self.add(t[0])
+
+    def add(self, rule):
+        flag = self.RULE
+        if rule.startswith(b'!'):
+            flag = self.EXCEPTION
+            rule = rule[1:]
+        try:
+            rule = rule.decode('utf-8').encode('idna')
+        except UnicodeError:
+            return
+        labels = rule.lower().split(b'.')
+
+        node = self.__root
+        for label in reversed(labels[1:]):
+            child = node.get(label, None)
+            if not isinstance(child, dict):
+                child = node[label] = {} if child is None else {b'': child}
+            node = child
+        child = node.get(labels[0], None)
+        if isinstance(child, dict):
+            child[b''] = flag
+        else:
+            node[labels[0]] = flag
+        self.rules += 1
+
+    ##
+    # Number of labels at the end of the lowercased labels that form the
+    # public suffix, or None if no rule covers them, i.e. the top level
+    # domain is unknown. Exception rules take precedence over wildcards.
+    ##
+    def suffix_labels(self, labels):
+        node = self.__root
+        match = None
+        for depth, label in enumerate(reversed(labels), 1):
+            child = node.get(label, None)
+            flag = child.get(b'', None) if isinstance(child, dict) else child
+            if flag == self.EXCEPTION:
+                return depth - 1
+            if flag == self.RULE or b'*' in node:
+                match = depth
+            if not isinstance(child, dict):
+                break
+            node = child
+        return match
+
+
+# Public suffix lists by path, each loaded once per process
+_public_suffix_lists = {}
+
+
+def load_public_suffixes(path):
+    t = _public_suffix_lists.get(path, None)
+    if t is None:
+        try:
+            t = _public_suffix_lists[path] = bro_intel_public_suffixes(path)
+        except IOError as e:
+            write_stderr('ERROR: Could not read public suffix list %s - %s' % (path, e.strerror))
+            sys.exit(1)
+    return t
+
+
 ###############################################################################
 # class bro_intel_indicator_type
 #
@@ -52,70 +723,60 @@ class bro_intel_indicator_return:
 # file. Note, each type of field has a specific handler.
 #
 class bro_intel_indicator_type:
-    def __init__(self):
-        self.__INDICATOR_TYPE_handler = {'Intel::ADDR':         self.__handle_intel_addr,
-                                         'Intel::NET':          self.__handle_intel_net,
-                                         'Intel::URL':          self.__handle_intel_url,
-                                         'Intel::SOFTWARE':     self.__handle_intel_software,
-                                         'Intel::EMAIL':        self.__handle_intel_email,
-                                         'Intel::DOMAIN':       self.__handle_intel_domain,
-                                         'Intel::USER_NAME':    self.__handle_intel_user_name,
-                                         'Intel::FILE_HASH':    self.__handle_intel_file_hash,
-                                         'Intel::FILE_NAME':    self.__handle_intel_file_name,
-                                         'Intel::CERT_HASH':    self.__handle_intel_cert_hash}
+    ##
+    # public_suffixes, a bro_intel_public_suffixes, additionally has domains
+    # checked against the public suffix list.
+    ##
+    def __init__(self, profile=None, public_suffixes=None):
+        self.__public_suffixes = public_suffixes
+        self.__INDICATOR_TYPE_handler = {b'Intel::ADDR':         self.__handle_intel_addr,
+                                         b'Intel::NET':          self.__handle_intel_net,
+                                         b'Intel::URL':          self.__handle_intel_url,
+                                         b'Intel::SOFTWARE':     self.__handle_intel_software,
+                                         b'Intel::EMAIL':        self.__handle_intel_email,
+                                         b'Intel::DOMAIN':       self.__handle_intel_domain,
+                                         b'Intel::USER_NAME':    self.__handle_intel_user_name,
+                                         b'Intel::FILE_HASH':    self.__handle_intel_file_hash,
+                                         b'Intel::FILE_NAME':    self.__handle_intel_file_name,
+                                         b'Intel::CERT_HASH':    self.__handle_intel_cert_hash}
+        if profile is not None:
+            for k, h in self.__INDICATOR_TYPE_handler.items():
+                self.__INDICATOR_TYPE_handler[k] = profile.wrap_verifier('handler', as_text(k), h)
+
+    VALID_HASH_LEN = HASH_LENGTHS
 
     def __handle_intel_addr(self, indicator):
         ret = (bro_intel_indicator_return.OKAY, None)
-        import socket
-        try:
-            socket.inet_aton(indicator)
-        except socket.error:
+        if parse_address(indicator) is None:
             ret = (bro_intel_indicator_return.ERROR, 'Invalid IP address')
         return ret
 
-    # In an effort to keep this script minimal and without requiring external
-    # libraries, we will verify an Intel::NET simply as:
-    #
-    # 0 <= octet < 255
-    # 0 <= netmask <= 32
-    #
+    # An Intel::NET is an IPv4 or IPv6 address followed by a prefix length of
+    # 0-32 or 0-128 respectively.
     def __handle_intel_net(self, indicator):
         ret = (bro_intel_indicator_return.OKAY, None)
-        if '/' in indicator:
-            addr, net = indicator.split('/')
-            if all([(int(x) >= 0 and int(x) < 255) for x in addr.split('.')]):
-                if not (int(net) >= 0 and int(x) <= 32):
-                    ret = (bro_intel_indicator_return.ERROR, 'Invalid network block designation')
-            else:
+        if b'/' in indicator:
+            addr, net = indicator.split(b'/', 1)
+            if parse_address(addr) is None:
                 ret = (bro_intel_indicator_return.ERROR, 'Invalid network address')
+            elif parse_network(indicator) is None:
+                ret = (bro_intel_indicator_return.ERROR, 'Invalid network block designation')
         else:
             ret = (bro_intel_indicator_return.ERROR, 'Invalid network designation')
         return ret
 
-    # We will call this minimalist, but effective.
     def __handle_intel_url(self, indicator):
         ret = (bro_intel_indicator_return.OKAY, None)
 
-        t_uri_present = re.findall(r'^https?://', indicator)
-        if t_uri_present is not None and len(t_uri_present) > 0:
+        if indicator.startswith(URI_SCHEMES):
             ret = (bro_intel_indicator_return.WARNING, 'URI present (e.g. http(s)://)')
-        else:
-            rx = re.compile(r'^[https?://]?'  # http:// or https://
-                            r'(?:(?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\.)+[A-Z]{2,6}\.?|'  # domain...
-                            r'localhost|'  # localhost...
-                            r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})' # ...or ip
-                            r'(?::\d+)?'  # optional port
-                            r'(?:/?|[/?]\S+)$', re.IGNORECASE)
-            t = rx.search(indicator)
-            if t:
-                ret = (bro_intel_indicator_return.OKAY, None)
+        elif not scan_url(indicator):
+            ret = (bro_intel_indicator_return.WARNING, 'Invalid URL')
         return ret
 
     def __handle_intel_email(self, indicator):
         ret = (bro_intel_indicator_return.WARNING, 'Invalid email address')
-        rx = r"(^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$)"
-        t_email = re.findall(rx, indicator)
-        if len(t_email) > 0:
+        if EMAIL_RX.search(indicator):
             ret = (bro_intel_indicator_return.OKAY, None)
         return ret
 
@@ -127,15 +788,19 @@ class bro_intel_indicator_type:
 
     def __handle_intel_domain(self, indicator):
         ret = (bro_intel_indicator_return.WARNING, 'Invalid domain name')
-        rx = r'(?=^.{4,253}$)(^((?!-)[a-zA-Z0-9-]{1,63}(?<!-)\.)+[a-zA-Z]{2,63}$)'
-        t_domain = re.findall(rx, indicator)
-        if len(t_domain) > 0:
-            if indicator in t_domain[0]:
-                ret = (bro_intel_indicator_return.OKAY, None)
+        if scan_domain(indicator):
+            ret = (bro_intel_indicator_return.OKAY, None)
+            if self.__public_suffixes is not None:
+                labels = indicator.lower().split(b'.')
+                n = self.__public_suffixes.suffix_labels(labels)
+                if n is None:
+                    ret = (bro_intel_indicator_return.WARNING, 'Unknown top level domain')
+                elif n >= len(labels):
+                    ret = (bro_intel_indicator_return.WARNING, 'Domain is a public suffix')
         return ret
 
     def __handle_intel_user_name(self, indicator):
-        ret = (bro_intel_indicator_return.WARNING, 'Invalid username - %s' % (indicator))
+        ret = (bro_intel_indicator_return.WARNING, 'Invalid username - %s' % (as_text(indicator)))
         if len(indicator) > 0:
             ret = (bro_intel_indicator_return.OKAY, None)
         return ret
@@ -146,29 +811,38 @@ class bro_intel_indicator_type:
             ret = (bro_intel_indicator_return.OKAY, None)
         return ret
 
-    # Pretty weak, but should suffice for now.
     def __handle_intel_file_hash(self, indicator):
         ret = (bro_intel_indicator_return.WARNING, 'Invalid hash length')
-        valid_hash_len = {32: 'md5',
-                          40: 'sha1',
-                          64: 'sha256'}
-        if valid_hash_len.get(len(indicator), None):
+        if len(indicator) in self.VALID_HASH_LEN:
             ret = (bro_intel_indicator_return.OKAY, None)
+            if not is_hex(indicator):
+                ret = (bro_intel_indicator_return.WARNING, 'Invalid hash - not hexadecimal')
         return ret
 
+    # A hex digest or a colon separated fingerprint of one
     def __handle_intel_cert_hash(self, indicator):
-        return (bro_intel_indicator_return.WARNING,
-                'Intel::CERT_HASH - Needs additional validation')
+        ret = (bro_intel_indicator_return.WARNING, 'Invalid certificate hash')
+        h = fingerprint_hex(indicator)
+        if h is not None and len(h) in self.VALID_HASH_LEN and is_hex(h):
+            ret = (bro_intel_indicator_return.OKAY, None)
+        return ret
+
+    def indicator_types(self):
+        return frozenset(self.__INDICATOR_TYPE_handler)
+
+    def get_handler(self, indicator_type):
+        return self.__INDICATOR_TYPE_handler.get(indicator_type, None)
 
     def verify_indicator_type(self, indicator_type):
-        ret = (bro_intel_indicator_return.ERROR, 'Invalid indicator - %s' % (indicator_type))
+        ret = (bro_intel_indicator_return.ERROR, 'Invalid indicator - %s' % (as_text(indicator_type)))
         it = self.__INDICATOR_TYPE_handler.get(indicator_type, None)
         if it is not None:
             ret = (bro_intel_indicator_return.OKAY, None)
         return ret
 
     def correlate(self, indicator, indicator_type):
-        ret = (bro_intel_indicator_return.WARNING, 'Could not correlate - %s with %s' % (indicator, indicator_type))
+        ret = (bro_intel_indicator_return.WARNING, 'Could not correlate - %s with %s' %
+               (as_text(indicator), as_text(indicator_type)))
         if len(indicator) > 1 and len(indicator_type) > 1:
             h = self.__INDICATOR_TYPE_handler.get(indicator_type, None)
             if h:
@@ -188,35 +862,38 @@ class bro_intel_indicator_type:
 # the class constructor.
 #
 class bro_data_intel_field_values:
-    EMPTY_FIELD_CHAR = '-'
-    META_DO_NOTICE = ['T', 'F']
-
-    META_IF_IN = ['-',
-                  'Conn::IN_ORIG',
-                  'Conn::IN_RESP',
-                  'Files::IN_HASH',
-                  'Files::IN_NAME',
-                  'DNS::IN_REQUEST',
-                  'DNS::IN_RESPONSE',
-                  'HTTP::IN_HOST_HEADER',
-                  'HTTP::IN_REFERRER_HEADER',
-                  'HTTP::IN_USER_AGENT_HEADER',
-                  'HTTP::IN_X_FORWARDED_FOR_HEADER',
-                  'HTTP::IN_URL',
-                  'SMTP::IN_MAIL_FROM',
-                  'SMTP::IN_RCPT_TO',
-                  'SMTP::IN_FROM',
-                  'SMTP::IN_TO',
-                  'SMTP::IN_RECEIVED_HEADER',
-                  'SMTP::IN_REPLY_TO',
-                  'SMTP::IN_X_ORIGINATING_IP_HEADER',
-                  'SMTP::IN_MESSAGE',
-                  'SSL::IN_SERVER_CERT',
-                  'SSL::IN_CLIENT_CERT',
-                  'SSL::IN_SERVER_NAME',
-                  'SMTP::IN_HEADER']
+    EMPTY_FIELD_CHAR = b'-'
+    META_DO_NOTICE = frozenset([b'T', b'F'])
 
-    def __init__(self):
+    VALID_CIF_SEVERITY = [b'-', b'low', b'medium', b'med', b'high']
+    _VALID_CIF_SEVERITY = frozenset(VALID_CIF_SEVERITY)
+
+    META_IF_IN = frozenset([b'-',
+                  b'Conn::IN_ORIG',
+                  b'Conn::IN_RESP',
+                  b'Files::IN_HASH',
+                  b'Files::IN_NAME',
+                  b'DNS::IN_REQUEST',
+                  b'DNS::IN_RESPONSE',
+                  b'HTTP::IN_HOST_HEADER',
+                  b'HTTP::IN_REFERRER_HEADER',
+                  b'HTTP::IN_USER_AGENT_HEADER',
+                  b'HTTP::IN_X_FORWARDED_FOR_HEADER',
+                  b'HTTP::IN_URL',
+                  b'SMTP::IN_MAIL_FROM',
+                  b'SMTP::IN_RCPT_TO',
+                  b'SMTP::IN_FROM',
+                  b'SMTP::IN_TO',
+                  b'SMTP::IN_RECEIVED_HEADER',
+                  b'SMTP::IN_REPLY_TO',
+                  b'SMTP::IN_X_ORIGINATING_IP_HEADER',
+                  b'SMTP::IN_MESSAGE',
+                  b'SSL::IN_SERVER_CERT',
+                  b'SSL::IN_CLIENT_CERT',
+                  b'SSL::IN_SERVER_NAME',
+                  b'SMTP::IN_HEADER'])
+
+    def __init__(self, profile=None, public_suffixes=None):
         self.__VERIFY = {'indicator':           self.verify_indicator,
                          'indicator_type':      self.verify_indicator_type,
                          'meta.do_notice':      self.verify_meta_do_notice,
@@ -230,19 +907,23 @@ class bro_data_intel_field_values:
                          'meta.cif_severity':   self.verify_meta_cif_severity,
                          'meta.cif_impact':     self.verify_meta_cif_impact}
 
-        self.biit = bro_intel_indicator_type()
+        self.profile = profile
+        self.biit = bro_intel_indicator_type(profile, public_suffixes)
 
     def get_verifier(self, v):
-        return self.__VERIFY.get(v, self.default)
+        f = self.__VERIFY.get(v, self.default)
+        if self.profile is not None:
+            f = self.profile.wrap_verifier('verifier', v, f)
+        return f
 
     def __verify_chars(self, t):
-        return all(ord(l) > 31 and ord(l) < 127 and l in string.printable for l in t)
+        return is_printable(t)
 
     def __is_ignore_field(self, t):
         return self.EMPTY_FIELD_CHAR in t
 
     def verify_indicator(self, t):
-        ret = (bro_intel_indicator_return.ERROR, 'Invalid indicator - %s' % (t))
+        ret = (bro_intel_indicator_return.ERROR, 'Invalid indicator - %s' % (as_text(t)))
         if len(t) > 1 and self.__verify_chars(t):
             ret = (bro_intel_indicator_return.OKAY, None)
         return ret
@@ -257,28 +938,28 @@ class bro_data_intel_field_values:
         ret = (bro_intel_indicator_return.OKAY, None)
         t_ret = t in bro_data_intel_field_values.META_DO_NOTICE
         if not t_ret:
-            ret = (bro_intel_indicator_return.ERROR, 'Invalid do_notice - %s' % (str(t)))
+            ret = (bro_intel_indicator_return.ERROR, 'Invalid do_notice - %s' % (as_text(t)))
         return ret
 
     def verify_meta_if_in(self, t):
         ret = (bro_intel_indicator_return.OKAY, None)
         t_ret = t in bro_data_intel_field_values.META_IF_IN
         if not t_ret:
-            ret = (bro_intel_indicator_return.ERROR, 'Invalid if_in - %s' % (str(t)))
+            ret = (bro_intel_indicator_return.ERROR, 'Invalid if_in - %s' % (as_text(t)))
         return ret
 
     def verify_meta_cif_confidence(self, t):
-        ret = (bro_intel_indicator_return.ERROR, 'Invalid confidence - %s - Needs to be 1-100' % (str(t)))
+        ret = (bro_intel_indicator_return.ERROR, 'Invalid confidence - %s - Needs to be 1-100' % (as_text(t)))
         try:
             t_int = int(t)
-            if isinstance(t_int, (int, long)) and (t_int > 0 and t_int < 100):
+            if isinstance(t_int, int) and (t_int > 0 and t_int <= 100):
                 ret = (bro_intel_indicator_return.OKAY, None)
         except ValueError:
-            ret = (bro_intel_indicator_return.ERROR, 'Invalid confidence - %s - Needs to be 1-100' % (str(t)))
+            ret = (bro_intel_indicator_return.ERROR, 'Invalid confidence - %s - Needs to be 1-100' % (as_text(t)))
         return ret
 
     def verify_meta_desc(self, t):
-        ret = (bro_intel_indicator_return.WARNING, 'Invalid desc - %s' % (t))
+        ret = (bro_intel_indicator_return.WARNING, 'Invalid desc - %s' % (as_text(t)))
         if self.__is_ignore_field(t):
             ret = (bro_intel_indicator_return.OKAY, None)
         elif len(t) > 1 and self.__verify_chars(t):
@@ -286,7 +967,7 @@ class bro_data_intel_field_values:
         return ret
 
     def verify_meta_source(self, t):
-        ret = (bro_intel_indicator_return.WARNING, 'Invalid source - %s' % (t))
+        ret = (bro_intel_indicator_return.WARNING, 'Invalid source - %s' % (as_text(t)))
         if self.__is_ignore_field(t):
             ret = (bro_intel_indicator_return.OKAY, None)
         elif len(t) > 1 and self.__verify_chars(t):
@@ -294,7 +975,7 @@ class bro_data_intel_field_values:
         return ret
 
     def verify_meta_url(self, t):
-        ret = (bro_intel_indicator_return.WARNING, 'Invalid url - %s' % (t))
+        ret = (bro_intel_indicator_return.WARNING, 'Invalid url - %s' % (as_text(t)))
         if self.__is_ignore_field(t):
             ret = (bro_intel_indicator_return.OKAY, None)
         elif len(t) > 1 and self.__verify_chars(t):
@@ -302,7 +983,7 @@ class bro_data_intel_field_values:
         return ret
 
     def verify_meta_whitelist(self, t):
-        ret = (bro_intel_indicator_return.OKAY, 'Invalid whitelist - %s' % (t))
+        ret = (bro_intel_indicator_return.OKAY, 'Invalid whitelist - %s' % (as_text(t)))
         if self.__is_ignore_field(t):
             ret = (bro_intel_indicator_return.OKAY, None)
         elif len(t) > 1 and self.__verify_chars(t):
@@ -310,24 +991,23 @@ class bro_data_intel_field_values:
         return ret
 
     def verify_meta_severity(self, t):
-        ret = (bro_intel_indicator_return.ERROR, 'Invalid severity - %s (valid: 1-10)' % (t))
+        ret = (bro_intel_indicator_return.ERROR, 'Invalid severity - %s (valid: 1-10)' % (as_text(t)))
         try:
             t_int = int(t)
-            if isinstance(t_int, (int, long)) and (t_int > 0 and t_int < 10):
+            if isinstance(t_int, int) and (t_int > 0 and t_int <= 10):
                 ret = (bro_intel_indicator_return.OKAY, None)
         except ValueError:
-            ret = (bro_intel_indicator_return.ERROR, 'Invalid severity - %s  (valid: 1-10)' % (t))
+            ret = (bro_intel_indicator_return.ERROR, 'Invalid severity - %s  (valid: 1-10)' % (as_text(t)))
         return ret
 
     def verify_meta_cif_severity(self, t):
-        VALID_SEVERITY = ['-', 'low', 'medium', 'med', 'high']
-        ret = (bro_intel_indicator_return.ERROR, 'Invalid cif_severity - %s (valid: %s)' % (t, ','.join(VALID_SEVERITY)))
-        if t in VALID_SEVERITY:
-            ret = (bro_intel_indicator_return.OKAY, None)
-        return ret
+        if t in self._VALID_CIF_SEVERITY:
+            return (bro_intel_indicator_return.OKAY, None)
+        return (bro_intel_indicator_return.ERROR, 'Invalid cif_severity - %s (valid: %s)' %
+                (as_text(t), as_text(b','.join(self.VALID_CIF_SEVERITY))))
 
     def verify_meta_cif_impact(self, t):
-        ret = (bro_intel_indicator_return.WARNING, 'Invalid cif_impact - %s' % (t))
+        ret = (bro_intel_indicator_return.WARNING, 'Invalid cif_impact - %s' % (as_text(t)))
         if self.__is_ignore_field(t):
             ret = (bro_intel_indicator_return.OKAY, None)
         elif len(t) > 1 and self.__verify_chars(t):
@@ -335,8 +1015,8 @@ class bro_data_intel_field_values:
         return ret
 
     def default(self, t):
-        ret = (bro_intel_indicator_return.WARNING, 'Invalid - %s' % (t))
-        write_stderr("Running default handler for: %s" % (t))
+        ret = (bro_intel_indicator_return.WARNING, 'Invalid - %s' % (as_text(t)))
+        write_stderr("Running default handler for: %s" % (as_text(t)))
         if self.__is_ignore_field(t):
             ret = (bro_intel_indicator_return.OKAY, None)
         elif len(t) > 1 and self.__verify_chars(t):
@@ -345,166 +1025,2106 @@ class bro_data_intel_field_values:
 
 
 ###############################################################################
-# class bro_intel_feed_verifier
+# class bro_intel_column_verifier
 #
-# This is the control class for Bro Intel Feed verification
+# Column-at-a-time counterpart of bro_data_intel_field_values, used by the
+# columnar verification mode. A kernel takes a whole column of field values
+# and returns (position, code, diagnostics) for every cell that is not OKAY or
+# that emitted diagnostics of its own. Enumerations and integer ranges are
+# checked as set membership over the column; any other verifier is applied
+# cell by cell.
 #
-class bro_intel_feed_verifier:
-    stock_required_fields = ['indicator',
-                             'indicator_type',
-                             'meta.source']
-    psled_required_fields = ['indicator',
-                             'indicator_type',
-                             'meta.source',
-                             'meta.desc']
-    field_header_designator = '#fields'
-    feed_rx = r'([\S]+)'
-    feed_sep_rx = r'(\t)+'
+class bro_intel_column_verifier:
+    def __init__(self, validator):
+        ERROR = bro_intel_indicator_return.ERROR
+        WARNING = bro_intel_indicator_return.WARNING
+        self.__validator = validator
+        self.__biit = validator.biit
+        v = validator
+        self.__kernels = {
+            v.verify_indicator_type:      self.__member(self.__biit.indicator_types(), ERROR),
+            v.verify_meta_do_notice:      self.__member(v.META_DO_NOTICE, ERROR),
+            v.verify_meta_if_in:          self.__member(v.META_IF_IN, ERROR),
+            v.verify_meta_cif_severity:   self.__member(v._VALID_CIF_SEVERITY, ERROR),
+            v.verify_meta_severity:       self.__int_range(v.verify_meta_severity, 1, 10),
+            v.verify_meta_cif_confidence: self.__int_range(v.verify_meta_cif_confidence, 1, 100),
+            v.verify_indicator:           self.__text(ERROR, allow_empty=False),
+            v.verify_meta_desc:           self.__text(WARNING),
+            v.verify_meta_source:         self.__text(WARNING),
+            v.verify_meta_url:            self.__text(WARNING),
+            v.verify_meta_cif_impact:     self.__text(WARNING),
+            v.verify_meta_whitelist:      lambda column: []}
+        self.__correlators = {
+            b'Intel::FILE_HASH': self.__hex(bro_intel_indicator_type.VALID_HASH_LEN, WARNING),
+            b'Intel::CERT_HASH': self.__hex(bro_intel_indicator_type.VALID_HASH_LEN, WARNING,
+                                            fingerprints=True)}
 
-    header_fields = []
+    def get_kernel(self, verifier):
+        func = getattr(verifier, 'func', verifier)
+        kernel = self.__kernels.get(func, None)
+        if kernel is None:
+            kernel = lambda column: self.__cells(verifier, enumerate(column))
+        elif func is not verifier:
+            kernel = self.__validator.profile.wrap_kernel('verifier', verifier.name, kernel)
+        return kernel
 
-    def __init__(self, options):
-        self.feed_file = options.feed_file
-        self.__feed_header_found = False
-        self.__num_of_fields = 0
-        self.required_fields = bro_intel_feed_verifier.stock_required_fields
-
-    def __make_one_indexed(self, l):
-        return map(lambda x: x+1, l)
-
-    def __is_start_of_feed(self, l):
-        ret = False
-        if len(l) >= 2:
-            if l[0] == self.field_header_designator:
-                ret = True
-        return ret
+    def __member(self, valid, code):
+        def kernel(column):
+            return [(i, code, None) for i, t in enumerate(column) if t not in valid]
+        return kernel
 
-    def __are_header_fields_valid(self, l):
-        ret = False
-        _fields_found = []
-        if l[0] == self.field_header_designator:
-            for index, item in enumerate(l):
-                if index == 0:
-                    continue
-                if item in self.required_fields:
-                    _fields_found.append(item)
-                self.header_fields.append(item)
+    ##
+    # Free text columns: longer than one printable character, or containing
+    # the empty field character when allow_empty is set. The printable check
+    # is done once over the whole column and only repeated per cell if the
+    # column as a whole fails it.
+    ##
+    def __text(self, code, allow_empty=True):
+        empty = bro_data_intel_field_values.EMPTY_FIELD_CHAR
 
-            t_list_diff = list(set(self.required_fields) - set(_fields_found))
-            if len(t_list_diff) == 0:
-                ret = True
+        def kernel(column):
+            if allow_empty:
+                cells = [(i, t) for i, t in enumerate(column) if empty not in t]
             else:
-                warning_line(0, 'Fields missing: %s' % (','.join(t_list_diff)))
-        return ret
+                cells = list(enumerate(column))
+            if is_printable(b''.join([t for i, t in cells])):
+                return [(i, code, None) for i, t in cells if len(t) <= 1]
+            return [(i, code, None) for i, t in cells if len(t) <= 1 or not is_printable(t)]
+        return kernel
 
-    def __count_fields(self, l):
-        return len(l) - 1
+    ##
+    # Hex digests of one of the valid lengths. As with __text() the hex check
+    # is done once over the whole column and only per cell if that fails.
+    # With fingerprints set, colon separated fingerprints are accepted too.
+    ##
+    def __hex(self, valid, code, fingerprints=False):
+        def kernel(cells):
+            if fingerprints:
+                cells = [(i, fingerprint_hex(t) or b'') if b':' in t else (i, t) for i, t in cells]
+            if is_hex(b''.join([t for i, t in cells])):
+                return [(i, code, None) for i, t in cells if len(t) not in valid]
+            return [(i, code, None) for i, t in cells if len(t) not in valid or not is_hex(t)]
+        return kernel
 
     ##
-    # <0 - Too few fields
-    #  0 - Proper field count
-    # >0 - Too many fields
+    # Canonical spellings of the range are matched as a set; anything else
+    # (leading zeros, signs, garbage) goes through the verifier itself so the
+    # int() semantics are kept exactly.
     ##
-    def __verify_field_count(self, l):
-        return len(l) - self.__num_of_fields
+    def __int_range(self, verifier, lo, hi):
+        valid = frozenset(str(i).encode('ascii') for i in range(lo, hi + 1))
 
-    def __verify_non_space(self, offset, l):
-        ret = True
+        def kernel(column):
+            return self.__cells(verifier, [(i, t) for i, t in enumerate(column) if t not in valid])
+        return kernel
 
-        r = [i for i, x in enumerate(l) if x == ' ']
-        if len(r) > 0:
-            warning_line(offset, 'Invalid empty field, offset %s' % (self.__make_one_indexed(r)))
-            ret = False
-        return ret
+    def __cells(self, verifier, cells):
+        OKAY = bro_intel_indicator_return.OKAY
+        saved = _diagnostics.capture
+        _diagnostics.capture = captured = []
+        out = []
+        try:
+            for i, t in cells:
+                r = verifier(t)
+                if captured or r[0] != OKAY:
+                    out.append((i, r[0], list(captured)))
+                    del captured[:]
+        finally:
+            _diagnostics.capture = saved
+        return out
 
-    def __get_field_contents(self, l):
-        return l.split('\t')
+    ##
+    # Column form of bro_intel_indicator_type.correlate(). Returns a dict of
+    # position -> code for every pair that does not correlate.
+    ##
+    def correlate(self, indicators, indicator_types):
+        OKAY = bro_intel_indicator_return.OKAY
+        WARNING = bro_intel_indicator_return.WARNING
+        groups = {}
+        for i, t in enumerate(indicator_types):
+            groups.setdefault(t, []).append(i)
 
-    def __verify_field_sep(self, offset, l, is_header=False):
-        ret = True
-        field_seps = re.findall(self.feed_sep_rx, l, re.IGNORECASE)
-        __field_total = self.__num_of_fields
+        out = {}
+        for t, positions in groups.items():
+            if len(t) <= 1:
+                out.update((i, WARNING) for i in positions)
+                continue
+            cells = []
+            for i in positions:
+                if len(indicators[i]) > 1:
+                    cells.append((i, indicators[i]))
+                else:
+                    out[i] = WARNING
+            kernel = self.__correlators.get(t, None)
+            if kernel is not None:
+                out.update((i, code) for i, code, d in kernel(cells))
+                continue
+            h = self.__biit.get_handler(t)
+            if h is not None:
+                for i, indicator in cells:
+                    code = h(indicator)[0]
+                    if code != OKAY:
+                        out[i] = code
+        return out
 
-        if is_header:
-            __field_total += 1
 
-        if len(field_seps) >= __field_total:
-            warning_line(offset, 'Excess field separators found')
-            ret = False
+###############################################################################
+# class bro_intel_duplicate_index
+#
+# Open-addressing hash table used to find duplicate (indicator,
+# indicator_type) pairs across a whole feed. Keys are 64 bit digests kept in
+# flat arrays, so millions of entries cost a few bytes each instead of a str
+# tuple apiece. Digests are kept to 63 bits so they stay machine integers.
+# Each slot also records a 32 bit digest of the entry's
+# meta.severity/meta.do_notice values and the first and last line the key
+# was seen on.
+#
+_DIGEST_TYPECODE = 'q'
 
-        for index, item in enumerate(field_seps):
-            for s in item:
-                if s != '\t':
-                    warning_line(offset, 'Field separator incorrect in field offset %d' %
-                                 (self.__make_one_indexed(index)))
-                    ret = False
-        return ret
+_DIGEST_STRUCT = struct.Struct('<q')
 
-    def __verify_header(self, index, l):
-        ret = False
-        contents = self.__get_field_contents(l)
-        if self.__is_start_of_feed(contents) and self.__are_header_fields_valid(contents):
-            if not self.__feed_header_found:
-                self.__num_of_fields = self.__count_fields(contents)
-                if self.__verify_field_sep(index, l, is_header=True):
-                    ret = True
-                    self.__feed_header_found = True
-                else:
-                    write_stderr("Invalid field separator found in header. Must be a tab.")
-            else:
-                warning_line(index, "Duplicate header found")
-        return ret
 
-    def __verify_fields(self, index, content):
-        ret = True
-        _fields_to_process = {}
-        validator = bro_data_intel_field_values()
-
-        #
-        # Not thrilled about this, but we need it to pull out correlatable fields
-        # since, order of the actual feed fields aren't guaranteed. Ugly for now,
-        # but workable and can likely be optimized shortly.
-        #
-        for content_index, t in enumerate(content):
-            _fields_to_process[self.header_fields[content_index]] = t
-
-        for k in _fields_to_process:
-            r = validator.get_verifier(k)(_fields_to_process[k])
-
-            if not r:
-                if all(ord(l) > 31 and ord(l) < 127 and l in string.printable for l in k):
-                    t_line = str(_fields_to_process[k])
-                    t_line = hex_escape(t_line)
-                    warning_line(index, 'Invalid entry \"%s\" for column \"%s\"' %
-                                 (str(t_line), str(k)))
-                else:
-                    warning_line(index, 'Unprintable character found for column \"%s\"' %
-                                 (str(k)))
-                ret = False
-                break
+def digest64(data):
+    return (_DIGEST_STRUCT.unpack(hashlib.md5(data).digest()[:8])[0] & 0x7fffffffffffffff) or 1
 
-        if ret:
-            # Special case to verify indicator with indicator_type
-            c = validator.correlate_indictor_and_indicator_type(
-                _fields_to_process['indicator'],
-                _fields_to_process['indicator_type'])
 
-            if not c:
-                warning_line(index,
-                             'Indicator type \"%s\" does not correlate with indicator: \"%s\"' %
-                             (_fields_to_process['indicator_type'],
-                              _fields_to_process['indicator']))
-                ret = False
-        return ret
+class bro_intel_duplicate_index:
+    NEW       = 0
+    DUPLICATE = 1
+    CONFLICT  = 2
+
+    def __init__(self, capacity=1 << 16):
+        self.__allocate(capacity)
+
+    def __allocate(self, capacity):
+        self.__mask = capacity - 1
+        self.__count = 0
+        self.__keys = array(_DIGEST_TYPECODE, [0]) * capacity
+        self.__values = array('I', [0]) * capacity
+        self.__first = array('i', [0]) * capacity
+        self.__last = array('i', [0]) * capacity
+
+    def __len__(self):
+        return self.__count
+
+    def __slot(self, key):
+        keys = self.__keys
+        mask = self.__mask
+        slot = key & mask
+        while keys[slot] != 0 and keys[slot] != key:
+            slot = (slot + 1) & mask
+        return slot
+
+    def __grow(self):
+        keys, values, first, last = self.__keys, self.__values, self.__first, self.__last
+        self.__allocate(len(keys) * 2)
+        for i, key in enumerate(keys):
+            if key:
+                slot = self.__slot(key)
+                self.__keys[slot] = key
+                self.__values[slot] = values[i]
+                self.__first[slot] = first[i]
+                self.__last[slot] = last[i]
+        self.__count = sum(1 for key in keys if key)
+
+    ##
+    # Record key (a digest64()) seen on line with the given value digest.
+    # Returns (status, first line the key was seen on).
+    ##
+    def add(self, key, value, line):
+        slot = self.__slot(key)
+        if self.__keys[slot] == key:
+            self.__last[slot] = line
+            if self.__values[slot] != value:
+                return self.CONFLICT, self.__first[slot]
+            return self.DUPLICATE, self.__first[slot]
+
+        self.__keys[slot] = key
+        self.__values[slot] = value
+        self.__first[slot] = line
+        self.__last[slot] = line
+        self.__count += 1
+        if self.__count * 4 >= len(self.__keys) * 3:
+            self.__grow()
+        return self.NEW, line
+
+    ##
+    # Returns (first line, last line, value digest) for key, or None.
+    ##
+    def get(self, key):
+        slot = self.__slot(key)
+        if self.__keys[slot] != key:
+            return None
+        return self.__first[slot], self.__last[slot], self.__values[slot]
+
+
+###############################################################################
+# class bro_intel_prefix_index
+#
+# Prefix index over the Intel::ADDR and Intel::NET entries of a feed, used to
+# find addresses already covered by a network and networks that overlap.
+# Networks are kept in one hash table per (version, prefix length), so finding
+# every network that covers an address or network costs one lookup per prefix
+# length in use. IPv4 addresses are kept as integers in flat arrays; all
+# addresses are checked once every network in the feed is known.
+#
+class bro_intel_prefix_index:
+    def __init__(self):
+        self.__nets = {4: {}, 6: {}}
+        self.__addrs4 = array(_DIGEST_TYPECODE)
+        self.__addrs4_lines = array('i')
+        self.__addrs6 = []
+        self.__overlaps = []
+
+    def add_addr(self, indicator, line):
+        a = parse_address(indicator)
+        if a is None:
+            return
+        version, value = a
+        if version == 4:
+            self.__addrs4.append(value)
+            self.__addrs4_lines.append(line)
+        else:
+            self.__addrs6.append((value, line))
+
+    def add_net(self, indicator, line):
+        n = parse_network(indicator)
+        if n is None:
+            return
+        version, plen, prefix = n
+        table = self.__nets[version].setdefault(plen, {})
+        if prefix in table:
+            self.__overlaps.append((line, 'Network \"%s\" overlaps network \"%s\" on line %d' %
+                                    (as_text(indicator), format_network(version, plen, prefix),
+                                     table[prefix] + 1)))
+        else:
+            table[prefix] = line
+
+    ##
+    # Returns (prefix length, prefix, line) of the broadest network that
+    # covers the prefix value of length plen, or None. Networks of the same
+    # length only count when inclusive is set, i.e. for addresses.
+    ##
+    def __covering(self, version, plen, value, lengths, inclusive=False):
+        for p in lengths:
+            if p > plen or (p == plen and not inclusive):
+                break
+            line = self.__nets[version][p].get(value >> (plen - p), None)
+            if line is not None:
+                return p, value >> (plen - p), line
+        return None
+
+    ##
+    # Returns the (line, message) overlaps found, in line order.
+    ##
+    def overlaps(self):
+        out = list(self.__overlaps)
+        for version in (4, 6):
+            nets = self.__nets[version]
+            lengths = sorted(nets)
+            if not lengths:
+                continue
+            bits = ADDRESS_BITS[version]
+            for plen in lengths:
+                for prefix, line in nets[plen].items():
+                    c = self.__covering(version, plen, prefix, lengths)
+                    if c is not None:
+                        out.append((line, 'Network \"%s\" overlaps network \"%s\" on line %d' %
+                                    (format_network(version, plen, prefix),
+                                     format_network(version, c[0], c[1]), c[2] + 1)))
+            if version == 4:
+                addrs = zip(self.__addrs4, self.__addrs4_lines)
+            else:
+                addrs = self.__addrs6
+            for value, line in addrs:
+                c = self.__covering(version, bits, value, lengths, inclusive=True)
+                if c is not None:
+                    out.append((line, 'Address \"%s\" is covered by network \"%s\" on line %d' %
+                                (format_address(version, value),
+                                 format_network(version, c[0], c[1]), c[2] + 1)))
+        out.sort()
+        return out
+
+
+###############################################################################
+# class bro_intel_verify_cache
+#
+# On-disk record of the entries that passed verification without any
+# diagnostics, so that unchanged entries can be skipped on the next run. The
+# file is a short header (magic, format version, rules version, a digest of
+# the #fields line and a digest of the verification settings) followed by the
+# sorted 64 bit digests of the passing entries, looked up by binary search.
+# The rules version is a digest of this script's source, so any change to the
+# verifiers invalidates the cache; so does a different #fields line, or any
+# setting that changes which entries pass, such as another public suffix
+# list.
+#
+CACHE_FORMAT_VERSION = 2
+
+
+##
+# md5 digest of the contents of the file at path, or None if it can not be
+# read
+##
+def file_digest(path):
+    try:
+        h = hashlib.md5()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        return h.digest()
+    except (IOError, OSError):
+        return None
+
+
+##
+# Create a uniquely named temporary file next to path, for a file that is
+# written and then renamed over path. The name is unique across the threads
+# of the daemon as well as across processes, and the file gets the mode a
+# plain open() would have given it. With keep_extension the name is hidden
+# and ends with the name of path, so its extension still selects the
+# compression.
+##
+def temporary_path(path, keep_extension=False):
+    head, tail = os.path.split(path)
+    if keep_extension:
+        fd, tmp = tempfile.mkstemp(prefix='.', suffix='.' + tail, dir=head or '.')
+    else:
+        fd, tmp = tempfile.mkstemp(prefix=tail + '.', suffix='.tmp', dir=head or '.')
+    try:
+        os.fchmod(fd, 0o666 & ~_umask())
+    finally:
+        os.close(fd)
+    return tmp
+
+
+_umask_value = []
+
+def _umask():
+    if not _umask_value:
+        mask = os.umask(0o022)
+        os.umask(mask)
+        _umask_value.append(mask)
+    return _umask_value[0]
+
+
+def verifier_rules_version():
+    try:
+        return file_digest(os.path.splitext(os.path.abspath(__file__))[0] + '.py')
+    except NameError:
+        return None
+
+
+class bro_intel_verify_cache:
+    MAGIC = b'PIPPVC\0\0'
+    HEADER = struct.Struct('<8sI16s16s16sQ')
+
+    ##
+    # settings is the digest of the verification settings, see
+    # bro_intel_feed_verifier.settings_digest().
+    ##
+    def __init__(self, path, header, settings):
+        self.path = path
+        self.rules_version = verifier_rules_version()
+        self.header_digest = hashlib.md5(header).digest()
+        self.settings_digest = settings
+        self.__known = array(_DIGEST_TYPECODE)
+        self.__passed = array(_DIGEST_TYPECODE)
+        self.hits = 0
+        if self.rules_version is not None:
+            self.__load()
+
+    def __load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                head = f.read(self.HEADER.size)
+                if len(head) != self.HEADER.size:
+                    return
+                magic, version, rules, header, settings, count = self.HEADER.unpack(head)
+                if (magic, version, rules, header, settings) != \
+                        (self.MAGIC, CACHE_FORMAT_VERSION, self.rules_version,
+                         self.header_digest, self.settings_digest):
+                    return
+                known = array(_DIGEST_TYPECODE)
+                known.fromfile(f, count)
+        except (IOError, OSError, EOFError, struct.error):
+            return
+        if sys.byteorder != 'little':
+            known.byteswap()
+        self.__known = known
+
+    ##
+    # Returns (digest of l, whether l passed cleanly on an earlier run). Hits
+    # are recorded for this run straight away.
+    ##
+    def lookup(self, l):
+        d = digest64(l)
+        known = self.__known
+        i = bisect.bisect_left(known, d)
+        if i < len(known) and known[i] == d:
+            self.__passed.append(d)
+            self.hits += 1
+            return d, True
+        return d, False
+
+    def add(self, d):
+        self.__passed.append(d)
+
+    ##
+    # Write the cache atomically. When the run was not complete the entries
+    # known from earlier runs are kept as well.
+    ##
+    def save(self, complete=True):
+        if self.rules_version is None:
+            return
+        digests = set(self.__passed)
+        if not complete:
+            digests.update(self.__known)
+        out = array(_DIGEST_TYPECODE, sorted(digests))
+        if sys.byteorder != 'little':
+            out.byteswap()
+        tmp = temporary_path(self.path)
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(self.HEADER.pack(self.MAGIC, CACHE_FORMAT_VERSION, self.rules_version,
+                                         self.header_digest, self.settings_digest, len(out)))
+                out.tofile(f)
+            os.rename(tmp, self.path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+
+
+###############################################################################
+# class bro_intel_compiled_feed
+#
+# Compact binary copy of a verified feed, written by --compile after a
+# successful verify() so that Bro-side loaders can map it instead of parsing
+# TSV. The file is a header (magic, format version, rules version, digest,
+# size and mtime of the source feed, row and column counts, number of
+# diagnostics the verification reported), the #fields line, a
+# table describing each column, one fixed-width record per row and then a
+# string table per column: the string offsets followed by the string data.
+#
+# Values are interned per column, up to COMPILED_INTERN_LIMIT distinct values
+# each, so repeated columns such as meta.source and meta.if_in are stored once
+# and their ids take one or two bytes of the record; unique columns such as
+# the indicator are stored as they come with 32 bit ids. Sections are 8 byte
+# aligned and the file is mapped read-only, so rows are decoded straight out
+# of the mapping. tsv_blocks() re-emits the feed's lines.
+#
+# A compiled feed whose rules version and source contents still match is
+# current. Verifying the feed again is skipped if it is, the verification
+# reported nothing and none of COMPILED_UNVOUCHED_OPTIONS is set, so that
+# skipping it changes nothing but the time taken.
+#
+COMPILED_FORMAT_VERSION = 2
+COMPILED_INTERN_LIMIT = 1 << 16
+COMPILED_ID_TYPES = [(1 << 8, 'B'), (1 << 16, 'H'), (1 << 32, 'I')]
+COMPILED_OFFSET_TYPES = {'I': 'I', 'q': _DIGEST_TYPECODE}
+# Checks and reports beyond the entries' own verification
+COMPILED_UNVOUCHED_OPTIONS = ['duplicates', 'overlaps', 'allowlist', 'public_suffix_list',
+                              'collect', 'max_errors', 'profile']
+
+
+class bro_intel_compiled_feed:
+    MAGIC = b'PIPPCF\0\0'
+    HEADER = struct.Struct('<8sI16s16sQdQIIQ')
+    # id type, offset type, number of strings, offsets position, data position
+    COLUMN = struct.Struct('<cc6xQQQ')
+    ALIGN = 8
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            head = f.read(self.HEADER.size)
+            if len(head) != self.HEADER.size:
+                raise ValueError('%s is not a compiled feed' % (path))
+            (magic, version, self.rules_version, self.source_digest, self.source_size,
+             self.source_mtime, self.rows, self.columns, header_size,
+             self.diagnostics) = self.HEADER.unpack(head)
+            if magic != self.MAGIC or version != COMPILED_FORMAT_VERSION:
+                raise ValueError('%s is not a compiled feed' % (path))
+            self.__map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            mm = self.__map
+            pos = self.HEADER.size
+            self.header = mm[pos:pos + header_size]
+            pos = self.align(pos + header_size)
+            self.__tables = []
+            for c in range(self.columns):
+                self.__tables.append(self.COLUMN.unpack_from(mm, pos))
+                pos += self.COLUMN.size
+            self.__codes = ''.join(t[0].decode('ascii') for t in self.__tables)
+            self.__row = struct.Struct('<' + self.__codes)
+            self.__records = self.align(pos)
+            for id_type, offset_type, strings, offsets, data in self.__tables:
+                if offset_type.decode('ascii') not in COMPILED_OFFSET_TYPES or data > len(mm):
+                    raise ValueError('%s is truncated or corrupt' % (path))
+        except (ValueError, struct.error):
+            self.close()
+            raise
+
+    @classmethod
+    def align(cls, n):
+        return (n + cls.ALIGN - 1) // cls.ALIGN * cls.ALIGN
+
+    def close(self):
+        self.__map.close()
+
+    def __len__(self):
+        return self.rows
+
+    ##
+    # Whether this was compiled from feed as it is now, under the current
+    # rules. Size and mtime rule out most changes cheaply; the digest of the
+    # contents is what decides.
+    ##
+    def is_current(self, feed):
+        rules = verifier_rules_version()
+        try:
+            st = os.stat(feed)
+        except OSError:
+            return False
+        return (rules is not None and rules == self.rules_version and
+                st.st_size == self.source_size and st.st_mtime == self.source_mtime and
+                file_digest(feed) == self.source_digest)
+
+    def __offsets(self, c):
+        id_type, offset_type, strings, pos, data = self.__tables[c]
+        offsets = array(COMPILED_OFFSET_TYPES[offset_type.decode('ascii')])
+        offsets.frombytes(self.__map[pos:pos + (strings + 1) * offsets.itemsize])
+        if sys.byteorder != 'little':
+            offsets.byteswap()
+        return offsets, data
+
+    ##
+    # The values of row i
+    ##
+    def row(self, i):
+        if not 0 <= i < self.rows:
+            raise IndexError('row %d out of range' % (i))
+        mm = self.__map
+        fields = []
+        ids = self.__row.unpack_from(mm, self.__records + i * self.__row.size)
+        for s, (id_type, offset_type, strings, offsets, data) in zip(ids, self.__tables):
+            word = struct.Struct('<2' + offset_type.decode('ascii'))
+            start, end = word.unpack_from(mm, offsets + s * word.size // 2)
+            fields.append(mm[data + start:data + end])
+        return fields
+
+    def __iter__(self):
+        for lines in self.tsv_blocks():
+            for l in lines:
+                yield l[:-1].split(b'\t')
+
+    ##
+    # Yield lists of newline terminated TSV lines, block_rows rows at a time,
+    # identical to the non-empty lines of the feed that was compiled. The
+    # #fields line is self.header and is not included.
+    ##
+    def tsv_blocks(self, block_rows=8192):
+        mm = self.__map
+        columns = self.columns
+        # Interned columns are small enough to decode once up front
+        tables = []
+        for c in range(columns):
+            offsets, data = self.__offsets(c)
+            strings = None
+            if len(offsets) <= COMPILED_INTERN_LIMIT:
+                strings = [mm[data + offsets[s]:data + offsets[s + 1]]
+                           for s in range(len(offsets) - 1)]
+            tables.append((offsets, data, strings))
+
+        block = struct.Struct('<' + self.__codes * block_rows)
+        for start in range(0, self.rows, block_rows):
+            count = min(block_rows, self.rows - start)
+            if count != block_rows:
+                block = struct.Struct('<' + self.__codes * count)
+            ids = block.unpack_from(mm, self.__records + start * self.__row.size)
+            cells = []
+            for c, (offsets, data, strings) in enumerate(tables):
+                if strings is not None:
+                    cells.append([strings[s] for s in ids[c::columns]])
+                else:
+                    cells.append([mm[data + offsets[s]:data + offsets[s + 1]]
+                                  for s in ids[c::columns]])
+            yield [b'\t'.join(row) + b'\n' for row in zip(*cells)]
+
+    ##
+    # Compile feed, which must already have been verified, to path. Ids are
+    # spooled as 32 bit values and packed to each column's width once the
+    # number of strings per column is known. The file is written under a
+    # temporary name and renamed into place.
+    ##
+    @classmethod
+    def compile(cls, feed, path, tmp_dir=None, block_rows=8192, diagnostics=0):
+        st = os.stat(feed)
+        source_digest = file_digest(feed) or b'\0' * 16
+        records = tempfile.TemporaryFile(dir=tmp_dir)
+        header = None
+        columns = []
+        rows = 0
+        try:
+            for lines in bro_intel_feed_reader(feed).blocks():
+                ids = array('I')
+                new = [[] for _ in columns]
+                for l in lines:
+                    if header is None:
+                        header = l
+                        columns = [({}, array(_DIGEST_TYPECODE, [0]), tempfile.TemporaryFile(dir=tmp_dir))
+                                   for _ in range(len(l.split(b'\t')) - 1)]
+                        new = [[] for _ in columns]
+                        continue
+                    fields = l.split(b'\t')
+                    if len(fields) != len(columns):
+                        raise ValueError('Entry has %d fields, the header %d - %s' %
+                                         (len(fields), len(columns), l))
+                    for (table, offsets, data), pending, t in zip(columns, new, fields):
+                        s = table.get(t)
+                        if s is None:
+                            s = len(offsets) - 1
+                            offsets.append(offsets[-1] + len(t))
+                            pending.append(t)
+                            if len(table) < COMPILED_INTERN_LIMIT:
+                                table[t] = s
+                        ids.append(s)
+                    rows += 1
+                ids.tofile(records)
+                for (table, offsets, data), pending in zip(columns, new):
+                    data.write(b''.join(pending))
+            if header is None:
+                raise ValueError('Feed is empty - %s' % (feed))
+
+            codes = ''
+            for table, offsets, data in columns:
+                for limit, code in COMPILED_ID_TYPES:
+                    if len(offsets) - 1 <= limit:
+                        codes += code
+                        break
+                else:
+                    raise ValueError('Feed has too many distinct values to compile - %s' % (feed))
+
+            tmp = temporary_path(path)
+            try:
+                with open(tmp, 'wb') as f:
+                    f.write(cls.HEADER.pack(cls.MAGIC, COMPILED_FORMAT_VERSION,
+                                            verifier_rules_version() or b'\0' * 16, source_digest,
+                                            st.st_size, st.st_mtime, rows, len(columns), len(header),
+                                            diagnostics))
+                    f.write(header)
+                    pos = cls.align(f.tell())
+                    f.write(b'\0' * (pos - f.tell()))
+
+                    # Lay out the string tables after the records
+                    tables = []
+                    end = cls.align(cls.align(pos + cls.COLUMN.size * len(columns)) +
+                                    rows * struct.calcsize('<' + codes))
+                    for code, (table, offsets, data) in zip(codes, columns):
+                        offset_type = 'I' if offsets[-1] < 1 << 32 else 'q'
+                        if offset_type == 'I':
+                            offsets = array('I', offsets)
+                        start = end
+                        end = cls.align(start + len(offsets) * offsets.itemsize)
+                        tables.append((offsets, data, start, end))
+                        f.write(cls.COLUMN.pack(code.encode('ascii'), offset_type.encode('ascii'),
+                                                len(offsets) - 1, start, end))
+                        end = cls.align(end + offsets[-1])
+                    f.write(b'\0' * (cls.align(f.tell()) - f.tell()))
+
+                    records.seek(0)
+                    ids = array('I')
+                    while True:
+                        chunk = records.read(block_rows * len(columns) * ids.itemsize)
+                        if not chunk:
+                            break
+                        ids = array('I')
+                        ids.frombytes(chunk)
+                        f.write(struct.pack('<' + codes * (len(ids) // len(columns)), *ids))
+
+                    for offsets, data, start, end in tables:
+                        f.write(b'\0' * (start - f.tell()))
+                        if sys.byteorder != 'little':
+                            offsets.byteswap()
+                        offsets.tofile(f)
+                        f.write(b'\0' * (end - f.tell()))
+                        data.seek(0)
+                        shutil.copyfileobj(data, f)
+                os.rename(tmp, path)
+            except BaseException:
+                if os.path.exists(tmp):
+                    os.unlink(tmp)
+                raise
+        finally:
+            records.close()
+            for table, offsets, data in columns:
+                data.close()
+        return rows
+
+
+##
+# Whether the compiled feed at path is current for feed and its verification
+# reported nothing, so that verifying feed again would report nothing either
+##
+def compiled_feed_is_current(path, feed):
+    try:
+        compiled = bro_intel_compiled_feed(path)
+    except (IOError, OSError, ValueError, struct.error):
+        return False
+    try:
+        return compiled.diagnostics == 0 and compiled.is_current(feed)
+    finally:
+        compiled.close()
+
+
+###############################################################################
+# Compressed feeds
+#
+# Feeds may be gzip, bzip2 or xz compressed. On read the format is taken from
+# the magic bytes at the start of the data, so compressed stdin works too; on
+# write it is taken from the file extension. STDIO_NAME reads stdin or writes
+# stdout. xz needs the lzma module, which Python can be built without.
+#
+STDIO_NAME = '-'
+COMPRESSION_MAGIC = [(b'\x1f\x8b', 'gz'),
+                     (b'BZh', 'bz2'),
+                     (b'\xfd7zXZ\x00', 'xz')]
+COMPRESSION_EXTENSIONS = {'.gz': 'gz',
+                          '.bz2': 'bz2',
+                          '.xz': 'xz'}
+
+
+def compression_from_magic(head):
+    for magic, kind in COMPRESSION_MAGIC:
+        if head.startswith(magic):
+            return kind
+    return None
+
+
+def feed_compression(path):
+    try:
+        with open(path, 'rb') as f:
+            return compression_from_magic(f.read(8))
+    except IOError:
+        return None
+
+
+def _require_lzma():
+    try:
+        import lzma
+    except ImportError:
+        write_stderr('ERROR: xz compressed feeds need Python built with the lzma module')
+        sys.exit(1)
+    return lzma
+
+
+def new_decompressor(kind):
+    if kind == 'gz':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif kind == 'bz2':
+        return bz2.BZ2Decompressor()
+    return _require_lzma().LZMADecompressor()
+
+
+def open_feed_output(path, buffer_size=-1):
+    if path == STDIO_NAME:
+        sys.stdout.flush()
+        return os.fdopen(os.dup(sys.stdout.fileno()), 'wb', buffer_size)
+    kind = COMPRESSION_EXTENSIONS.get(os.path.splitext(path)[1].lower(), None)
+    if kind == 'gz':
+        return gzip.GzipFile(path, 'wb', 6)
+    elif kind == 'bz2':
+        return bz2.BZ2File(path, 'w')
+    elif kind == 'xz':
+        return _require_lzma().LZMAFile(path, 'w')
+    return open(path, 'wb', buffer_size)
+
+
+def remove_feed_output(path):
+    if path != STDIO_NAME:
+        os.unlink(path)
+
+
+###############################################################################
+# class bro_intel_shard_writer
+#
+# Output stage of the append pipeline. Rows are written to one feed, or split
+# into several smaller ones that Bro workers load more efficiently: by
+# indicator type (feed.ADDR.dat, feed.DOMAIN.dat, ...) or by a stable CRC-32
+# of the indicator into a fixed number of shards (feed.0.dat ... feed.N.dat).
+# Every file gets the #fields header and its own buffered writer. Files are
+# written under a hidden temporary name in the same directory and only
+# renamed into place by close(), so Bro never sees a partly written feed;
+# discard() removes them instead. close() also removes the shards of this
+# feed that an earlier run wrote and this one did not, such as a type with no
+# rows left or the shards above a reduced count, as Bro would load those
+# too. stdout is written directly and can not be sharded.
+#
+class bro_intel_shard_writer:
+    shard_modes = ['type', 'hash']
+
+    ##
+    # key_index is the column sharded on: indicator_type for 'type',
+    # indicator for 'hash'.
+    ##
+    def __init__(self, path, header, shard_by=None, shards=1, key_index=0, buffer_size=-1):
+        self.path = path
+        self.header = header
+        self.shard_by = shard_by
+        self.shards = shards
+        self.key_index = key_index
+        self.buffer_size = buffer_size
+        self.__outs = {}
+        if shard_by is None:
+            self.__shard(None)
+        elif shard_by == 'hash':
+            for i in range(shards):
+                self.__shard(self.__hash_shard_name(i))
+
+    def __hash_shard_name(self, i):
+        return '%0*d' % (len(str(self.shards - 1)), i)
+
+    ##
+    # Path of a shard: the shard name goes before the feed's extension, and
+    # before its compression extension if it has one.
+    ##
+    def shard_path(self, name):
+        if name is None:
+            return self.path
+        root, ext = self.__split_path()
+        return '%s.%s%s' % (root, name, ext)
+
+    def __split_path(self):
+        root, ext = os.path.splitext(self.path)
+        if ext.lower() in COMPRESSION_EXTENSIONS:
+            root, inner = os.path.splitext(root)
+            ext = inner + ext
+        return root, ext
+
+    ##
+    # Shards of this feed already on disk: type names are upper case, hash
+    # shard names are digits, either way of sharding may have written them.
+    ##
+    def __existing_shards(self):
+        root, ext = self.__split_path()
+        head, tail = os.path.split(root)
+        pattern = re.compile(re.escape(tail) + r'\.[A-Z0-9_]+' + re.escape(ext) + '$')
+        try:
+            names = os.listdir(head or '.')
+        except OSError:
+            return []
+        return [os.path.join(head, n) for n in names if pattern.match(n)]
+
+    def __shard(self, name):
+        out = self.__outs.get(name, None)
+        if out is None:
+            path = self.shard_path(name)
+            tmp = path
+            if path != STDIO_NAME:
+                # Keep the extension, it selects the compression
+                tmp = temporary_path(path, keep_extension=True)
+            f = open_feed_output(tmp, self.buffer_size)
+            out = self.__outs[name] = (f, tmp, path)
+            f.write(self.header)
+        return out[0]
+
+    ##
+    # Write a list of newline terminated rows
+    ##
+    def write(self, rows):
+        if self.shard_by is None:
+            self.__shard(None).write(b''.join(rows))
+            return
+
+        groups = {}
+        n = self.key_index
+        for row in rows:
+            key = row.split(b'\t', n + 1)[n]
+            if self.shard_by == 'type':
+                name = as_text(key.split(b'::', 1)[-1])
+            else:
+                name = self.__hash_shard_name((zlib.crc32(key) & 0xffffffff) % self.shards)
+            groups.setdefault(name, []).append(row)
+        for name, group in groups.items():
+            self.__shard(name).write(b''.join(group))
+
+    ##
+    # Finish every file and move it into place. Returns the paths written.
+    ##
+    def close(self):
+        outs = sorted(self.__outs.values(), key=lambda out: out[2])
+        self.__outs = {}
+        for f, tmp, path in outs:
+            f.close()
+        written = [path for f, tmp, path in outs]
+        if self.shard_by is not None:
+            for path in self.__existing_shards():
+                if path not in written:
+                    os.unlink(path)
+        for f, tmp, path in outs:
+            if tmp != path:
+                os.rename(tmp, path)
+        return written
+
+    def discard(self):
+        outs = list(self.__outs.values())
+        self.__outs = {}
+        for f, tmp, path in outs:
+            f.close()
+            if tmp != path:
+                os.unlink(tmp)
+
+
+##
+# Put item on the bounded queue q, waiting for room until stop is set.
+# Returns False if stop was set first, as the consumer is gone then and
+# would never make room.
+##
+def queue_put(q, item, stop):
+    while not stop.is_set():
+        try:
+            q.put(item, True, 0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+###############################################################################
+# class bro_intel_pipeline
+#
+# Staged processing of a feed: a reader thread, a validation stage and a
+# writer thread connected by bounded queues of batches of batch_size rows, so
+# at most a few queue_depth batches are held however large the feed is, and
+# reading and writing overlap validation. The validation stage runs batches
+# through a pool of workers processes, as threads would take turns on the
+# GIL, with at most queue_depth batches in flight and results handed back in
+# input order. With workers = 0 it runs in the calling thread.
+#
+class bro_intel_pipeline:
+    def __init__(self, workers=0, queue_depth=4, batch_size=2000):
+        self.workers = workers
+        self.queue_depth = max(1, queue_depth)
+        self.batch_size = max(1, batch_size)
+
+    ##
+    # Split blocks of lines into batches of at most batch_size lines
+    ##
+    def rebatch(self, blocks):
+        n = self.batch_size
+        for lines in blocks:
+            for i in range(0, len(lines), n):
+                yield lines[i:i + n]
+
+    ##
+    # Iterate source in a background thread, queue_depth items ahead
+    ##
+    def read(self, source):
+        q = queue.Queue(self.queue_depth)
+        stop = threading.Event()
+        t = threading.Thread(target=self.__produce, args=(source, q, stop))
+        t.daemon = True
+        t.start()
+        try:
+            while True:
+                item = q.get()
+                if item is None:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            t.join()
+
+    ##
+    # Background half of read(). Puts the items of source on q, then None
+    # at the end or the exception that stopped it. source is closed when
+    # the consumer stops early, so it can release its own resources.
+    ##
+    def __produce(self, source, q, stop):
+        try:
+            for item in source:
+                if not queue_put(q, item, stop):
+                    return
+            queue_put(q, None, stop)
+        except BaseException as e:
+            queue_put(q, e, stop)
+        finally:
+            close = getattr(source, 'close', None)
+            if close is not None:
+                close()
+
+    ##
+    # Yield func(batch) for every batch, in order. With workers the batches
+    # go to a process pool set up by initializer(*initargs) and are handed
+    # to worker_func there.
+    ##
+    def validate(self, batches, func, worker_func=None, initializer=None, initargs=()):
+        if not self.workers:
+            for batch in batches:
+                yield func(batch)
+            return
+
+        pool = multiprocessing.Pool(self.workers, initializer, initargs)
+        pending = collections.deque()
+        try:
+            for batch in batches:
+                pending.append(pool.apply_async(worker_func, (batch,)))
+                if len(pending) >= self.queue_depth:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def writer(self, write):
+        return bro_intel_background_writer(write, self.queue_depth)
+
+
+##
+# Calls write() for every put() item in a background thread, queue_depth
+# items behind. An error in write() is raised again by the next put() or by
+# close().
+##
+class bro_intel_background_writer:
+    def __init__(self, write, queue_depth=4):
+        self.__write = write
+        self.__queue = queue.Queue(queue_depth)
+        self.__error = None
+        self.__thread = threading.Thread(target=self.__consume)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def __consume(self):
+        while True:
+            item = self.__queue.get()
+            if item is None:
+                return
+            if self.__error is None:
+                try:
+                    self.__write(item)
+                except BaseException as e:
+                    self.__error = e
+
+    def __raise(self):
+        if self.__error is not None:
+            e, self.__error = self.__error, None
+            raise e
+
+    def put(self, item):
+        self.__raise()
+        self.__queue.put(item)
+
+    ##
+    # Wait for every item to be written
+    ##
+    def close(self):
+        self.__queue.put(None)
+        self.__thread.join()
+        self.__raise()
+
+    ##
+    # Stop without raising; items still queued may or may not be written
+    ##
+    def abort(self):
+        self.__error = self.__error or SystemExit()
+        self.__queue.put(None)
+        self.__thread.join()
+
+
+###############################################################################
+# class bro_intel_feed_reader
+#
+# Memory-mapped, bytes-level reader for Bro Intel feeds. Newlines are located
+# with mmap.find() and lines are handed out as bytes slices of the mapping,
+# so nothing is decoded before it is verified. As with the original text
+# reader, blank lines are skipped and trailing carriage returns stripped.
+#
+# Compressed feeds and stdin can not be mapped and are streamed instead:
+# a background thread reads and decompresses block_size chunks into a queue
+# of queue_depth entries, so decompression overlaps with verification.
+#
+class bro_intel_feed_reader:
+    queue_depth = 4
+
+    def __init__(self, feed, block_size=1 << 20, profile=None):
+        self.feed = feed
+        self.block_size = block_size
+        self.profile = profile
+
+    def __iter__(self):
+        for lines in self.blocks():
+            for l in lines:
+                yield l
+
+    def is_stream(self):
+        return self.feed == STDIO_NAME or feed_compression(self.feed) is not None
+
+    def __lines(self, chunk):
+        if b'\r' in chunk:
+            return [t for t in (l.rstrip(b'\r') for l in chunk.split(b'\n')) if t]
+        return [t for t in chunk.split(b'\n') if t]
+
+    ##
+    # Yield lists of the non-empty lines found between byte offsets start
+    # and end, roughly block_size bytes at a time. Blocks always end on a
+    # line boundary. Streamed feeds are always read whole.
+    ##
+    def blocks(self, start=0, end=None):
+        if self.is_stream():
+            return self.__stream_blocks()
+        return self.__mapped_blocks(start, end)
+
+    def __mapped_blocks(self, start, end):
+        with open(self.feed, 'rb') as f:
+            try:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # Empty files can not be mapped
+                return
+            try:
+                if end is None or end > len(mm):
+                    end = len(mm)
+                pos = start
+                while pos < end:
+                    t0 = _clock()
+                    stop = min(pos + self.block_size, end)
+                    if stop < end:
+                        nl = mm.rfind(b'\n', pos, stop)
+                        if nl < 0:
+                            nl = mm.find(b'\n', stop, end)
+                        stop = end if nl < 0 else nl + 1
+                    lines = self.__lines(mm[pos:stop])
+                    if self.profile is not None:
+                        self.profile.add('stage', 'read', _clock() - t0)
+                    yield lines
+                    pos = stop
+            finally:
+                mm.close()
+
+    def __stream_blocks(self):
+        if self.feed == STDIO_NAME:
+            f = getattr(sys.stdin, 'buffer', sys.stdin)
+        else:
+            f = open(self.feed, 'rb')
+        head = f.read(self.block_size)
+        kind = compression_from_magic(head)
+        d = new_decompressor(kind) if kind is not None else None
+
+        q = queue.Queue(self.queue_depth)
+        stop = threading.Event()
+        t = threading.Thread(target=self.__decompress, args=(f, head, kind, d, q, stop))
+        t.daemon = True
+        t.start()
+
+        tail = b''
+        try:
+            while True:
+                t0 = _clock()
+                data = q.get()
+                if data is None:
+                    break
+                if isinstance(data, Exception):
+                    write_stderr('ERROR: Could not read %s - %s' % (self.feed, data))
+                    sys.exit(1)
+                data = tail + data
+                nl = data.rfind(b'\n')
+                if nl < 0:
+                    tail = data
+                    continue
+                tail = data[nl + 1:]
+                lines = self.__lines(data[:nl + 1])
+                if self.profile is not None:
+                    self.profile.add('stage', 'read', _clock() - t0)
+                yield lines
+            lines = self.__lines(tail)
+            if lines:
+                yield lines
+        finally:
+            # The thread must not be left holding stdin at interpreter exit
+            stop.set()
+            t.join()
+
+    ##
+    # Background half of __stream_blocks(). Puts decompressed chunks on q,
+    # then None at the end of the feed or the exception that stopped it.
+    # Concatenated streams, as written by e.g. pigz or pbzip2, are followed
+    # into the next stream.
+    ##
+    def __decompress(self, f, data, kind, d, q, stop):
+        try:
+            while data:
+                if d is None:
+                    out, data = data, b''
+                else:
+                    try:
+                        out = d.decompress(data)
+                    except EOFError:
+                        # The last stream ended exactly at the end of a chunk
+                        d = new_decompressor(kind)
+                        continue
+                    data = d.unused_data
+                    if data:
+                        d = new_decompressor(kind)
+                if out and not queue_put(q, out, stop):
+                    return
+                if not data:
+                    data = f.read(self.block_size)
+            queue_put(q, None, stop)
+        except Exception as e:
+            queue_put(q, e, stop)
+        finally:
+            if self.feed != STDIO_NAME:
+                f.close()
+
+    ##
+    # Return the first non-empty line and the byte offset just past it, or
+    # (None, 0) if the feed has no content. The offset is None for streamed
+    # feeds.
+    ##
+    def header(self):
+        if self.is_stream():
+            blocks = self.__stream_blocks()
+            try:
+                for lines in blocks:
+                    if lines:
+                        return lines[0], None
+            finally:
+                blocks.close()
+            return None, 0
+
+        with open(self.feed, 'rb') as f:
+            try:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                return None, 0
+            try:
+                pos = 0
+                while pos < len(mm):
+                    nl = mm.find(b'\n', pos)
+                    stop = len(mm) if nl < 0 else nl + 1
+                    t_line = mm[pos:stop].rstrip(b'\r\n')
+                    if len(t_line):
+                        return t_line, stop
+                    pos = stop
+            finally:
+                mm.close()
+        return None, 0
+
+
+###############################################################################
+# class bro_intel_external_sort
+#
+# Bounded-memory sort of byte lines. Lines are buffered until buffer_size
+# bytes are held, then sorted and spilled to a run file in a private
+# temporary directory. Iterating yields every line in order through a k-way
+# merge of the runs and the in-memory remainder; when there are more than
+# fan_in runs they are first merged in groups of fan_in. Lines must not
+# contain newlines.
+#
+class bro_intel_external_sort:
+    fan_in = 64
+    file_buffer = 1 << 16
+
+    def __init__(self, buffer_size=64 << 20, tmp_dir=None):
+        self.buffer_size = buffer_size
+        self.tmp_dir = tmp_dir
+        self.__dir = None
+        self.__buffer = []
+        self.__buffered = 0
+        self.__runs = []
+        self.__run_count = 0
+
+    def add(self, line):
+        line += b'\n'
+        self.__buffer.append(line)
+        self.__buffered += sys.getsizeof(line)
+        if self.__buffered >= self.buffer_size:
+            self.__spill()
+
+    def __new_run(self):
+        if self.__dir is None:
+            self.__dir = tempfile.mkdtemp(prefix='pipp-sort-', dir=self.tmp_dir)
+        self.__run_count += 1
+        return os.path.join(self.__dir, 'run%06d' % (self.__run_count))
+
+    def __spill(self):
+        self.__buffer.sort()
+        path = self.__new_run()
+        with open(path, 'wb', self.file_buffer) as f:
+            f.writelines(self.__buffer)
+        self.__runs.append(path)
+        self.__buffer = []
+        self.__buffered = 0
+
+    def __merge_runs(self, paths):
+        path = self.__new_run()
+        files = [open(p, 'rb', self.file_buffer) for p in paths]
+        try:
+            with open(path, 'wb', self.file_buffer) as f:
+                f.writelines(heapq.merge(*files))
+        finally:
+            for t_file in files:
+                t_file.close()
+        for p in paths:
+            os.unlink(p)
+        return path
+
+    ##
+    # Yields newline terminated lines in sorted order.
+    ##
+    def __iter__(self):
+        # Leave room for the in-memory buffer in the final merge
+        while len(self.__runs) >= self.fan_in:
+            group = self.__runs[:self.fan_in]
+            self.__runs = self.__runs[self.fan_in:] + [self.__merge_runs(group)]
+
+        self.__buffer.sort()
+        files = [open(p, 'rb', self.file_buffer) for p in self.__runs]
+        try:
+            for l in heapq.merge(self.__buffer, *files):
+                yield l
+        finally:
+            for t_file in files:
+                t_file.close()
+
+    def close(self):
+        self.__buffer = []
+        self.__runs = []
+        if self.__dir is not None:
+            shutil.rmtree(self.__dir, ignore_errors=True)
+            self.__dir = None
+
+
+###############################################################################
+# class bro_intel_allowlist
+#
+# Indicators that are known to be benign, compiled once from a plain list of
+# values (one per line, first whitespace separated field, '#' comments) into
+# a file that is memory mapped on later runs instead of being read into a
+# set. Keys are compared lowercased and hashed once with md5: the first 64
+# bits pick a block of a blocked Bloom filter and are also the sort key of
+# the key table, the next 63 bits give the ALLOWLIST_HASHES bit positions
+# within the block. A miss costs one filter block read. A hit is confirmed
+# against the stored keys: the top bits of the digest index a directory of
+# buckets of about ALLOWLIST_BUCKET keys, which are compared in turn, so
+# false positives never suppress an entry.
+#
+# The file is the header, the filter, the bucket directory, the sorted
+# digests, an offset table and the keys in digest order. It is written next
+# to the source as <source>.bloom and rebuilt when the source's size or
+# modification time change; a compiled file may also be given directly.
+#
+ALLOWLIST_FORMAT_VERSION = 1
+ALLOWLIST_SUFFIX = '.bloom'
+# Filter bits per key and bits set per key. 16/7 gives well under 1% false
+# positives, which only cost the exact check.
+ALLOWLIST_BITS = 16
+ALLOWLIST_HASHES = 7
+ALLOWLIST_BUCKET = 4
+
+
+class bro_intel_allowlist:
+    MAGIC = b'PIPPAL\0\0'
+    HEADER = struct.Struct('<8sIQdQQI')
+    BLOCK_SIZE = 64
+    WORD = struct.Struct('<Q')
+    WORD_PAIR = struct.Struct('<QQ')
+    # Big endian, so that digests sort like their hex form
+    KEY_HASH = struct.Struct('>QQ')
+
+    ##
+    # name is what diagnostics call the allowlist, by default path
+    ##
+    def __init__(self, path, name=None):
+        self.path = path
+        self.name = name or path
+        with open(path, 'rb') as f:
+            head = f.read(self.HEADER.size)
+            if len(head) != self.HEADER.size:
+                raise ValueError('truncated allowlist')
+            magic, version, self.source_size, self.source_mtime, self.count, self.blocks, \
+                self.bucket_bits = self.HEADER.unpack(head)
+            if (magic, version) != (self.MAGIC, ALLOWLIST_FORMAT_VERSION):
+                raise ValueError('not a compiled allowlist')
+            self.__map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.__directory = self.HEADER.size + self.blocks * self.BLOCK_SIZE
+        self.__digests = self.__directory + ((1 << self.bucket_bits) + 1) * self.WORD.size
+        self.__offsets = self.__digests + self.count * self.WORD.size
+        self.__keys = self.__offsets + (self.count + 1) * self.WORD.size
+
+    def __len__(self):
+        return self.count
+
+    @classmethod
+    def is_compiled(cls, path):
+        with open(path, 'rb') as f:
+            return f.read(len(cls.MAGIC)) == cls.MAGIC
+
+    def __digest(self, i):
+        return self.WORD.unpack_from(self.__map, self.__digests + i * self.WORD.size)[0]
+
+    def __key(self, i):
+        k0, k1 = self.WORD_PAIR.unpack_from(self.__map, self.__offsets + i * self.WORD.size)
+        return self.__map[self.__keys + k0:self.__keys + k1]
+
+    def __contains__(self, key):
+        if not self.count:
+            return False
+        key = key.lower()
+        h1, h2 = self.KEY_HASH.unpack(hashlib.md5(key).digest())
+        start = self.HEADER.size + (h1 % self.blocks) * self.BLOCK_SIZE
+        block = bytearray(self.__map[start:start + self.BLOCK_SIZE])
+        for i in range(ALLOWLIST_HASHES):
+            j = h2 & 0x1ff
+            if not block[j >> 3] & (1 << (j & 7)):
+                return False
+            h2 >>= 9
+
+        start, end = self.WORD_PAIR.unpack_from(self.__map, self.__directory + (
+            h1 >> (64 - self.bucket_bits)) * self.WORD.size)
+        for i in range(start, end):
+            d = self.__digest(i)
+            if d == h1 and self.__key(i) == key:
+                return True
+            if d > h1:
+                break
+        return False
+
+    ##
+    # Compile the allowlist source into path. Keys are sorted by digest with
+    # bro_intel_external_sort, so memory stays bounded by the filter and the
+    # directory, digest and offset tables. The file is written under a
+    # temporary name and renamed.
+    ##
+    @classmethod
+    def compile(cls, source, path, tmp_dir=None):
+        st = os.stat(source)
+        sort = bro_intel_external_sort(tmp_dir=tmp_dir)
+        data = None
+        tmp = temporary_path(path)
+        try:
+            n = 0
+            for l in bro_intel_feed_reader(source):
+                fields = l.split()
+                if fields and not fields[0].startswith(b'#'):
+                    key = fields[0].lower()
+                    sort.add(binascii.hexlify(hashlib.md5(key).digest()) + key)
+                    n += 1
+
+            blocks = max(1, (n * ALLOWLIST_BITS + cls.BLOCK_SIZE * 8 - 1) // (cls.BLOCK_SIZE * 8))
+            bloom = bytearray(blocks * cls.BLOCK_SIZE)
+            bucket_bits = (n // ALLOWLIST_BUCKET).bit_length()
+            directory = array(_DIGEST_TYPECODE)
+            digests = array(_DIGEST_TYPECODE)
+            offsets = array(_DIGEST_TYPECODE)
+            data = tempfile.TemporaryFile(dir=tmp_dir)
+            pos = 0
+            last = None
+            for l in sort:
+                if l == last:
+                    continue
+                last = l
+                key = l[32:-1]
+                h1, h2 = cls.KEY_HASH.unpack(binascii.unhexlify(l[:32]))
+                start = (h1 % blocks) * cls.BLOCK_SIZE
+                for i in range(ALLOWLIST_HASHES):
+                    j = h2 & 0x1ff
+                    bloom[start + (j >> 3)] |= 1 << (j & 7)
+                    h2 >>= 9
+                while len(directory) <= h1 >> (64 - bucket_bits):
+                    directory.append(len(digests))
+                digests.append(h1 - (1 << 64) if h1 >= 1 << 63 else h1)
+                offsets.append(pos)
+                data.write(key)
+                pos += len(key)
+            count = len(offsets)
+            offsets.append(pos)
+            while len(directory) <= 1 << bucket_bits:
+                directory.append(count)
+            if sys.byteorder != 'little':
+                directory.byteswap()
+                digests.byteswap()
+                offsets.byteswap()
+
+            with open(tmp, 'wb') as f:
+                f.write(cls.HEADER.pack(cls.MAGIC, ALLOWLIST_FORMAT_VERSION, st.st_size,
+                                        st.st_mtime, count, blocks, bucket_bits))
+                f.write(bloom)
+                directory.tofile(f)
+                digests.tofile(f)
+                offsets.tofile(f)
+                data.seek(0)
+                shutil.copyfileobj(data, f)
+            os.rename(tmp, path)
+        finally:
+            sort.close()
+            if data is not None:
+                data.close()
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+
+
+# Allowlists by source path, each compiled and mapped once per process
+_allowlists = {}
+
+
+def load_allowlist(source, tmp_dir=None):
+    t = _allowlists.get(source, None)
+    if t is not None:
+        return t
+    try:
+        if bro_intel_allowlist.is_compiled(source):
+            t = bro_intel_allowlist(source, source)
+        else:
+            t = _load_compiled_allowlist(source, tmp_dir)
+    except (IOError, OSError) as e:
+        write_stderr('ERROR: Could not read allowlist %s - %s' % (source, e.strerror))
+        sys.exit(1)
+    except (ValueError, struct.error) as e:
+        write_stderr('ERROR: Could not read allowlist %s - %s' % (source, e))
+        sys.exit(1)
+    _allowlists[source] = t
+    return t
+
+
+def _load_compiled_allowlist(source, tmp_dir):
+    path = source + ALLOWLIST_SUFFIX
+    st = os.stat(source)
+    try:
+        t = bro_intel_allowlist(path, source)
+        if (t.source_size, t.source_mtime) == (st.st_size, st.st_mtime):
+            return t
+    except (IOError, OSError, ValueError, struct.error):
+        pass
+
+    try:
+        bro_intel_allowlist.compile(source, path, tmp_dir)
+    except (IOError, OSError):
+        # No room next to the source: keep a private copy that is mapped and
+        # then unlinked, and so lasts exactly as long as this process
+        fd, path = tempfile.mkstemp(prefix='pipp-allow-', suffix=ALLOWLIST_SUFFIX, dir=tmp_dir)
+        os.close(fd)
+        try:
+            bro_intel_allowlist.compile(source, path, tmp_dir)
+            return bro_intel_allowlist(path, source)
+        finally:
+            os.unlink(path)
+    return bro_intel_allowlist(path, source)
+
+
+###############################################################################
+# class bro_intel_feed_verifier
+#
+# This is the control class for Bro Intel Feed verification
+#
+class bro_intel_feed_verifier:
+    stock_required_fields = ['indicator',
+                             'indicator_type',
+                             'meta.source']
+    psled_required_fields = ['indicator',
+                             'indicator_type',
+                             'meta.source',
+                             'meta.desc']
+    field_header_designator = '#fields'
+    feed_rx = r'([\S]+)'
+    feed_sep_rx = r'(\t)+'
+
+    # Minimum number of bytes handed to a worker in parallel mode
+    min_chunk_size = 1 << 20
+    # Read and write buffer size used by the streaming append pipeline
+    block_size = 1 << 20
+    # Columns whose values must agree between duplicate entries
+    conflict_fields = ['meta.severity',
+                       'meta.do_notice']
+    dedupe_modes = ['first', 'last']
+    allowlist_actions = ['flag', 'drop']
+
+    ##
+    # validator, if given, is a bro_data_intel_field_values to share instead
+    # of building one, as the daemon does.
+    ##
+    def __init__(self, options, validator=None):
+        self.feed_file = options.feed_file
+        self.header_fields = []
+        self.profile = bro_intel_profile() if getattr(options, 'profile', False) else None
+        self.profile_format = getattr(options, 'profile_format', None) or 'table'
+        self.public_suffix_list = getattr(options, 'public_suffix_list', None)
+        self.normalize_domains = getattr(options, 'normalize_domains', False)
+        self.normalize_hashes = getattr(options, 'normalize_hashes', False)
+        self.__normalizers = {}
+        if self.normalize_domains:
+            self.__normalizers.update({b'Intel::DOMAIN': normalize_domain,
+                                       b'Intel::URL':    normalize_url})
+        if self.normalize_hashes:
+            self.__normalizers.update({b'Intel::FILE_HASH': normalize_hash,
+                                       b'Intel::CERT_HASH': normalize_hash})
+        if validator is None:
+            public_suffixes = None
+            if self.public_suffix_list is not None:
+                public_suffixes = load_public_suffixes(self.public_suffix_list)
+            validator = bro_data_intel_field_values(self.profile, public_suffixes)
+        self.__validator = validator
+        self.__column_plan = ()
+        self.__indicator_index = None
+        self.__indicator_type_index = None
+        self.__conflict_indexes = ()
+        self.dedupe = getattr(options, 'dedupe', None)
+        self.check_duplicates = getattr(options, 'duplicates', False) or self.dedupe is not None
+        self.__duplicates = None
+        self.duplicates_dropped = 0
+        self.check_overlaps = getattr(options, 'overlaps', False)
+        self.__prefixes = None
+        self.allowlist_files = getattr(options, 'allowlist', None) or []
+        self.allowlist_action = getattr(options, 'allowlist_action', None) or 'flag'
+        self.__allowlists = [load_allowlist(path, getattr(options, 'tmp_dir', None))
+                             for path in self.allowlist_files]
+        self.allowlisted_dropped = 0
+        self.shard_by = getattr(options, 'shard_by', None)
+        self.shards = getattr(options, 'shards', None) or 1
+        self.cache_file = getattr(options, 'cache_file', None)
+        # The verification cache is only consulted by the serial path
+        self.__pipeline = None
+        if getattr(options, 'pipeline', False) and self.cache_file is None:
+            self.__pipeline = bro_intel_pipeline(getattr(options, 'workers', 1),
+                                                 getattr(options, 'queue_depth', None) or 4,
+                                                 getattr(options, 'batch_size', None) or 2000)
+        self.__cache = None
+        self.columnar = getattr(options, 'columnar', False)
+        self.max_errors = getattr(options, 'max_errors', None)
+        self.collect_all = getattr(options, 'collect', False) or self.max_errors is not None
+        self.diagnostics_file = getattr(options, 'diagnostics_file', None)
+        self.diagnostics_out = getattr(options, 'diagnostics_out', None)
+        self.__diagnostics = None
+        self.__diagnostics_opened = None
+        self.entries_rejected = 0
+        self.__feed_header_found = False
+        self.__num_of_fields = 0
+        self.required_fields = bro_intel_feed_verifier.stock_required_fields
+
+        if self.profile is not None:
+            self.__tokenize = self.profile.wrap('stage', 'split', self.__tokenize)
+            self.__verify_field_sep = self.profile.wrap('stage', 'separator', self.__verify_field_sep,
+                                                        failed=lambda r: not r)
+            self.__verify_non_space = self.profile.wrap('stage', 'separator', self.__verify_non_space,
+                                                        failed=lambda r: not r)
+            self.__check_allowlists = self.profile.wrap('stage', 'allowlist', self.__check_allowlists,
+                                                        failed=lambda r: not r)
+
+    def __make_one_indexed(self, l):
+        return [x + 1 for x in l]
+
+    def __is_start_of_feed(self, l):
+        ret = False
+        if len(l) >= 2:
+            if l[0] == self.field_header_designator:
+                ret = True
+        return ret
+
+    def __are_header_fields_valid(self, l):
+        ret = False
+        _fields_found = []
+        if l[0] == self.field_header_designator:
+            for index, item in enumerate(l):
+                if index == 0:
+                    continue
+                if item in self.required_fields:
+                    _fields_found.append(item)
+                self.header_fields.append(item)
+
+            # In the order of required_fields, so the message is the same on
+            # every run
+            t_list_diff = [k for k in self.required_fields if k not in _fields_found]
+            if len(t_list_diff) == 0:
+                ret = True
+            else:
+                report_line(0, 'Fields missing: %s' % (','.join(t_list_diff)),
+                            bro_intel_indicator_return.ERROR,
+                            bro_intel_diagnostic_code.HEADER, value=','.join(t_list_diff))
+        return ret
+
+    def __count_fields(self, l):
+        return len(l) - 1
+
+    ##
+    # <0 - Too few fields
+    #  0 - Proper field count
+    # >0 - Too many fields
+    ##
+    def __verify_field_count(self, l):
+        return len(l) - self.__num_of_fields
+
+    ##
+    # spaces are the positions of the space-only fields, as found by
+    # tokenize_row().
+    ##
+    def __verify_non_space(self, offset, spaces):
+        ret = True
+
+        if len(spaces) > 0:
+            report_line(offset, 'Invalid empty field, offset %s' % (self.__make_one_indexed(spaces)),
+                        bro_intel_indicator_return.ERROR, bro_intel_diagnostic_code.EMPTY_FIELD,
+                        ','.join(self.header_fields[i] for i in spaces if i < len(self.header_fields)))
+            ret = False
+        return ret
+
+    def __get_field_contents(self, l):
+        return l.split(b'\t')
+
+    def __tokenize(self, l):
+        return tokenize_row(l)
+
+    ##
+    # separators is the number of tabs in the line, as counted by
+    # tokenize_row().
+    ##
+    def __verify_field_sep(self, offset, separators, is_header=False):
+        ret = True
+        __field_total = self.__num_of_fields
+
+        if is_header:
+            __field_total += 1
+
+        if separators >= __field_total:
+            report_line(offset, 'Excess field separators found',
+                        bro_intel_indicator_return.ERROR, bro_intel_diagnostic_code.FIELD_SEPARATOR)
+            ret = False
+        return ret
+
+    ##
+    # Digest of the settings, besides the rules and the #fields line, that
+    # decide whether an entry passes verification on its own: the public
+    # suffix list, by path and contents. Everything else that changes the
+    # outcome (allowlists, duplicates, overlaps) is checked after the cache.
+    ##
+    def settings_digest(self):
+        h = hashlib.md5()
+        if self.public_suffix_list is not None:
+            h.update(as_bytes(os.path.abspath(self.public_suffix_list)) + b'\0')
+            h.update(file_digest(self.public_suffix_list) or b'\0' * 16)
+        return h.digest()
+
+    def __verify_header(self, index, l):
+        ret = False
+        contents, separators, spaces = self.__tokenize(l)
+        contents = [as_text(t) for t in contents]
+        if self.__is_start_of_feed(contents) and self.__are_header_fields_valid(contents):
+            if not self.__feed_header_found:
+                self.__num_of_fields = self.__count_fields(contents)
+                if self.__verify_field_sep(index, separators, is_header=True):
+                    ret = True
+                    self.__feed_header_found = True
+                    self.__compile_column_plan()
+                    if self.cache_file is not None:
+                        self.__cache = bro_intel_verify_cache(self.cache_file, l,
+                                                              self.settings_digest())
+                else:
+                    write_stderr("Invalid field separator found in header. Must be a tab.")
+            else:
+                report_line(index, "Duplicate header found",
+                            bro_intel_indicator_return.ERROR, bro_intel_diagnostic_code.HEADER)
+        return ret
+
+    ##
+    # Compile the header into a positional plan, a tuple of
+    # (column index, verifier, column name), and cache the positions of the
+    # indicator and indicator_type columns used for correlation. Entries are
+    # then verified by walking their split fields directly.
+    ##
+    def __compile_column_plan(self):
+        get_verifier = self.__validator.get_verifier
+        self.__column_plan = tuple((i, get_verifier(k), k)
+                                   for i, k in enumerate(self.header_fields))
+        self.__indicator_index = self.header_fields.index('indicator')
+        self.__indicator_type_index = self.header_fields.index('indicator_type')
+        self.__column_verifier = bro_intel_column_verifier(self.__validator)
+        self.__conflict_indexes = tuple(i for i, k in enumerate(self.header_fields)
+                                        if k in self.conflict_fields)
+        if self.check_duplicates:
+            self.__duplicates = bro_intel_duplicate_index()
+        if self.check_overlaps:
+            self.__prefixes = bro_intel_prefix_index()
+
+    def __report_invalid_entry(self, index, k, t, level):
+        if is_printable(k):
+            report_line(index, 'Invalid entry \"%s\" for column \"%s\"' %
+                        (hex_escape(t), k),
+                        level, bro_intel_diagnostic_code.INVALID_VALUE, k, t)
+        else:
+            report_line(index, 'Unprintable character found for column \"%s\"' %
+                        (k),
+                        level, bro_intel_diagnostic_code.UNPRINTABLE, k, t)
+
+    def __report_correlation(self, index, indicator, indicator_type, level):
+        report_line(index,
+                    'Indicator type \"%s\" does not correlate with indicator: \"%s\"' %
+                    (as_text(indicator_type), as_text(indicator)),
+                    level, bro_intel_diagnostic_code.CORRELATION, 'indicator', indicator)
+
+    ##
+    # ERROR results reject the entry, WARNING results are reported and the
+    # entry is still accepted. In collect_all mode every column is checked
+    # even after an ERROR so that all of the entry's problems are reported.
+    ##
+    def __verify_fields(self, index, content):
+        OKAY = bro_intel_indicator_return.OKAY
+        ERROR = bro_intel_indicator_return.ERROR
+        ret = True
+
+        for i, verifier, k in self.__column_plan:
+            r = verifier(content[i])
+            if r[0] != OKAY:
+                self.__report_invalid_entry(index, k, content[i], r[0])
+                if r[0] == ERROR:
+                    if not self.collect_all:
+                        return False
+                    ret = False
+
+        # Special case to verify indicator with indicator_type
+        indicator = content[self.__indicator_index]
+        indicator_type = content[self.__indicator_type_index]
+        c = self.__validator.correlate_indictor_and_indicator_type(indicator, indicator_type)
+        if c[0] != OKAY:
+            self.__report_correlation(index, indicator, indicator_type, c[0])
+            if c[0] == ERROR:
+                return False
+        return ret
+
+    ##
+    # Normalize the indicator with the normalizer for its type, if any: see
+    # normalize_domain(), normalize_url() and normalize_hash(). Entries with
+    # the wrong number of fields are left for verification to report.
+    ##
+    def __normalize_entry(self, l):
+        contents = l.split(b'\t')
+        if len(contents) != self.__num_of_fields:
+            return l
+        normalize = self.__normalizers.get(contents[self.__indicator_type_index], None)
+        if normalize is None:
+            return l
+        contents[self.__indicator_index] = normalize(contents[self.__indicator_index])
+        return b'\t'.join(contents)
+
+    def __duplicate_key(self, contents):
+        key = digest64(contents[self.__indicator_index] + b'\t' +
+                       contents[self.__indicator_type_index])
+        value = zlib.crc32(b'\t'.join([contents[i] for i in self.__conflict_indexes])) & 0xffffffff
+        return key, value
+
+    def __is_tracking(self):
+        return self.__duplicates is not None or self.__prefixes is not None or bool(self.__allowlists)
+
+    ##
+    # Feed a verified entry to the allowlists and the cross-row indexes.
+    # Returns False if the entry is to be dropped from the output.
+    ##
+    def __track_entry(self, index, l):
+        contents = self.__get_field_contents(l)
+        if self.__allowlists and not self.__check_allowlists(index, contents):
+            return False
+        if self.__duplicates is not None and not self.__check_duplicate(index, contents):
+            return False
+        if self.__prefixes is not None:
+            indicator_type = contents[self.__indicator_type_index]
+            if indicator_type == b'Intel::ADDR':
+                self.__prefixes.add_addr(contents[self.__indicator_index], index)
+            elif indicator_type == b'Intel::NET':
+                self.__prefixes.add_net(contents[self.__indicator_index], index)
+        return True
+
+    ##
+    # Flag an entry whose indicator is on an allowlist, or with
+    # allowlist_action 'drop' count it and return False to leave it out.
+    ##
+    def __check_allowlists(self, index, contents):
+        indicator = contents[self.__indicator_index]
+        for allowlist in self.__allowlists:
+            if indicator in allowlist:
+                if self.allowlist_action == 'drop':
+                    self.allowlisted_dropped += 1
+                    return False
+                report_line(index, 'Indicator \"%s\" (%s) is on allowlist %s' %
+                            (as_text(indicator), as_text(contents[self.__indicator_type_index]),
+                             allowlist.name),
+                            code=bro_intel_diagnostic_code.ALLOWLISTED, column='indicator',
+                            value=indicator)
+                break
+        return True
+
+    def __report_overlaps(self):
+        if self.__prefixes is not None:
+            for line, msg in self.__prefixes.overlaps():
+                report_line(line, msg, code=bro_intel_diagnostic_code.OVERLAP, column='indicator')
+
+    ##
+    # Track a verified entry in the duplicate index and report duplicates
+    # and conflicting meta values. Returns False if the entry is to be
+    # dropped from the output under --dedupe.
+    ##
+    def __check_duplicate(self, index, contents):
+        key, value = self.__duplicate_key(contents)
+
+        # Last occurrences are only indexed by the pre-pass of append(); on
+        # any other path --dedupe last keeps the first entry instead
+        occurrence = self.__duplicates.get(key) if self.dedupe == 'last' else None
+        if occurrence is not None:
+            first, last, first_value = occurrence
+            if value != first_value and index != first:
+                self.__report_conflict(index, contents, first)
+            keep = index == last
+        else:
+            status, first = self.__duplicates.add(key, value, index)
+            if status == bro_intel_duplicate_index.CONFLICT:
+                self.__report_conflict(index, contents, first)
+            elif status == bro_intel_duplicate_index.DUPLICATE and self.dedupe is None:
+                report_line(index, 'Duplicate indicator \"%s\" (%s), first seen on line %d' %
+                            (as_text(contents[self.__indicator_index]),
+                             as_text(contents[self.__indicator_type_index]), first + 1),
+                            code=bro_intel_diagnostic_code.DUPLICATE, column='indicator',
+                            value=contents[self.__indicator_index])
+            keep = self.dedupe is None or status == bro_intel_duplicate_index.NEW
+
+        if not keep:
+            self.duplicates_dropped += 1
+        return keep
+
+    def __report_conflict(self, index, contents, first):
+        report_line(index, 'Conflicting %s for indicator \"%s\" (%s), first seen on line %d' %
+                    ('/'.join(self.conflict_fields), as_text(contents[self.__indicator_index]),
+                     as_text(contents[self.__indicator_type_index]), first + 1),
+                    code=bro_intel_diagnostic_code.CONFLICT, column='indicator',
+                    value=contents[self.__indicator_index])
+
+    ##
+    # Pre-pass for --dedupe last: record where every (indicator,
+    # indicator_type) pair last occurs. Only entries that will be written
+    # count, those that pass verification and are not dropped by an
+    # allowlist, so a bad last copy does not take the good ones with it. The
+    # diagnostics of this pass are discarded; the main pass reports them.
+    ##
+    def __index_last_occurrences(self):
+        saved, count = _diagnostics.capture, _diagnostics.count
+        _diagnostics.capture = []
+        try:
+            for index, l in enumerate(self.load_feed(self.feed_file)):
+                if index == 0:
+                    continue
+                if self.__normalizers:
+                    l = self.__normalize_entry(l)
+                verified = self.__verify_entry(index, l)
+                del _diagnostics.capture[:]
+                if not verified:
+                    continue
+                contents = self.__get_field_contents(l)
+                if self.allowlist_action == 'drop' and \
+                        any(contents[self.__indicator_index] in a for a in self.__allowlists):
+                    continue
+                key, value = self.__duplicate_key(contents)
+                self.__duplicates.add(key, value, index)
+        finally:
+            _diagnostics.capture, _diagnostics.count = saved, count
+
+    ##
+    # Columnar counterpart of __verify_entry() for a block of entries, the
+    # first of which is on line index. Rows with structural problems are
+    # handed to __verify_entry() for their diagnostics; all other rows are
+    # transposed into columns and each column is checked in one kernel call.
+    # Diagnostics are then emitted per row, in line order and exactly as the
+    # row path would emit them, and duplicates are tracked. Returns one flag
+    # per processed row; with stop_on_error processing ends after the first
+    # bad row.
+    ##
+    def __verify_block(self, index, lines, stop_on_error=True):
+        OKAY = bro_intel_indicator_return.OKAY
+        ERROR = bro_intel_indicator_return.ERROR
+        n = self.__num_of_fields
+        t0 = _clock()
+        rows = [l.split(b'\t') for l in lines]
+        if self.profile is not None:
+            self.profile.add('stage', 'split', _clock() - t0, len(lines))
+
+        # With the right number of fields a row can not have excess or
+        # foreign separators, so __verify_field_sep() need not be repeated.
+        good = [pos for pos, c in enumerate(rows) if len(c) == n and b' ' not in c]
+        columns = list(zip(*[rows[pos] for pos in good]))
+
+        issues = {}
+        if good:
+            for order, (i, verifier, k) in enumerate(self.__column_plan):
+                for cpos, code, diagnostics in self.__column_verifier.get_kernel(verifier)(columns[i]):
+                    issues.setdefault(good[cpos], []).append((order, code, diagnostics, i, k))
+            correlation = self.__column_verifier.correlate(columns[self.__indicator_index],
+                                                           columns[self.__indicator_type_index])
+            correlation = dict((good[cpos], code) for cpos, code in correlation.items())
+        else:
+            correlation = {}
+
+        structural = set(range(len(rows))).difference(good)
+        flags = []
+        for pos, contents in enumerate(rows):
+            line = index + pos
+            ok = True
+            if pos in structural:
+                ok = self.__verify_entry(line, lines[pos])
+            else:
+                for order, code, diagnostics, i, k in sorted(issues.get(pos, ())):
+                    if diagnostics:
+                        replay_diagnostics(diagnostics, line)
+                    if code != OKAY:
+                        self.__report_invalid_entry(line, k, contents[i], code)
+                        if code == ERROR:
+                            ok = False
+                            if not self.collect_all:
+                                break
+                code = correlation.get(pos, OKAY)
+                if (ok or self.collect_all) and code != OKAY:
+                    self.__report_correlation(line, contents[self.__indicator_index],
+                                              contents[self.__indicator_type_index], code)
+                    ok = ok and code != ERROR
+            if ok and self.__is_tracking():
+                self.__track_entry(line, lines[pos])
+            flags.append(ok)
+            if not ok and stop_on_error:
+                break
+        return flags
+
+    def verify_columnar(self):
+        index = 0
+        for lines in self.load_feed_blocks(self.feed_file):
+            if index == 0:
+                if not self.__verify_header(index, lines[0]):
+                    self.__report_invalid_header(index)
+                    sys.exit(2)
+                lines = lines[1:]
+                index = 1
+            flags = self.__verify_block(index, lines, stop_on_error=not self.collect_all)
+            if not all(flags):
+                self.__reject_entry(flags.count(False))
+            if self.__is_capped():
+                break
+            index += len(lines)
+
+        if index == 0:
+            self.__report_invalid_header(index)
+            sys.exit(2)
+        self.__report_overlaps()
 
     def __verify_entry(self, index, l):
         ret = False
-        contents = self.__get_field_contents(l)
+        contents, separators, spaces = self.__tokenize(l)
         _content_field_count = self.__verify_field_count(contents)
         _warn_str = None
 
         if _content_field_count == 0:
-            if self.__verify_field_sep(index, l) and self.__verify_non_space(index, contents) and self.__verify_fields(index, contents):
+            if self.collect_all:
+                ret = all([self.__verify_field_sep(index, separators),
+                           self.__verify_non_space(index, spaces),
+                           self.__verify_fields(index, contents)])
+            elif self.__verify_field_sep(index, separators) and self.__verify_non_space(index, spaces) and self.__verify_fields(index, contents):
                 ret = True
         elif _content_field_count > 0:
             _warn_str = 'Invalid number of fields - Found: %d, Header Fields: %d - Look for: EXTRA fields or tab seperators' % (len(contents), self.__num_of_fields)
@@ -512,110 +3132,1443 @@ class bro_intel_feed_verifier:
             _warn_str = 'Invalid number of fields - Found: %d, Header Fields: %d - Look for: EMPTY fields' % (len(contents), self.__num_of_fields)
 
         if _warn_str:
-            warning_line(index, _warn_str)
+            report_line(index, _warn_str,
+                        bro_intel_indicator_return.ERROR, bro_intel_diagnostic_code.FIELD_COUNT)
+
+        return ret
+
+    ##
+    # __verify_entry() through the verification cache: entries that passed
+    # cleanly on an earlier run are accepted without being verified again,
+    # and entries that pass now without any diagnostics are recorded.
+    ##
+    def __verify_cached_entry(self, index, l):
+        cache = self.__cache
+        if cache is None:
+            return self.__verify_entry(index, l)
 
+        d, hit = cache.lookup(l)
+        if hit:
+            return True
+
+        before = _diagnostics.count
+        ret = self.__verify_entry(index, l)
+        if ret and _diagnostics.count == before:
+            cache.add(d)
         return ret
 
+    def __save_cache(self, complete):
+        if self.__cache is not None:
+            self.__cache.save(complete)
+
+    def __report_invalid_header(self, index):
+        report_line(index, "Invalid header",
+                    bro_intel_indicator_return.ERROR, bro_intel_diagnostic_code.HEADER)
+
+    ##
+    # Structured diagnostics for collect_all mode. The collector is installed
+    # by the outermost entry point only and closed, with its summary, however
+    # that entry point ends. Diagnostics go to diagnostics_out if set, else to
+    # diagnostics_file or stdout.
+    ##
+    def __open_diagnostics(self):
+        if not self.collect_all or _diagnostics.collector is not None:
+            return False
+        if self.diagnostics_out is not None:
+            out = self.diagnostics_out
+        elif self.diagnostics_file is None or self.diagnostics_file == '-':
+            out = sys.stdout
+        else:
+            out = open(self.diagnostics_file, 'w')
+        self.__diagnostics = _diagnostics.collector = bro_intel_diagnostics(out, self.max_errors)
+        self.__diagnostics_opened = out
+        return True
+
+    def __close_diagnostics(self):
+        _diagnostics.collector = None
+        self.__diagnostics.allowlisted_dropped = self.allowlisted_dropped
+        self.__diagnostics.close()
+        out = self.__diagnostics_opened
+        if out is not self.diagnostics_out and out is not sys.stdout:
+            out.close()
+
+    def __report_profile(self, start):
+        if self.profile is not None:
+            self.profile.add('stage', 'total', _clock() - start)
+            self.profile.report(sys.stderr, self.profile_format)
+
+    def __reject_entry(self, count=1):
+        if not self.collect_all:
+            sys.exit(3)
+        self.entries_rejected += count
+
+    def __is_capped(self):
+        return self.__diagnostics is not None and self.__diagnostics.capped
+
     def load_feed(self, feed):
-        with open(feed) as f:
-            for line in f:
-                t_line = line.rstrip('\r\n')
-                if len(t_line):
-                    yield t_line
+        return iter(bro_intel_feed_reader(feed, self.block_size, self.profile))
+
+    ##
+    # Yield lists of the non-empty lines of the feed, in order, reading it
+    # block_size bytes at a time.
+    ##
+    def load_feed_blocks(self, feed, block_size=None):
+        return bro_intel_feed_reader(feed, block_size or self.block_size, self.profile).blocks()
+
+    ##
+    # Single pass verify-and-append pipeline. The feed is read once, every
+    # entry is verified and written out with append_fields/append_values
+    # added. By default the first bad entry aborts the run and the partial
+    # output is removed; with reject_file set, bad entries are written there
+    # instead and processing continues. Returns (entries written, rejected).
+    ##
+    def append(self, new_file, append_fields, append_values, reject_file=None):
+        opened = self.__open_diagnostics()
+        start = _clock()
+        try:
+            ret = self.__append(new_file, append_fields, append_values, reject_file)
+        finally:
+            if opened:
+                self.__close_diagnostics()
+            self.__report_profile(start)
+        if self.entries_rejected:
+            sys.exit(3)
+        return ret
+
+    def __append(self, new_file, append_fields, append_values, reject_file):
+        for k, t in zip(append_fields, append_values):
+            r = self.__validator.get_verifier(k)(t)
+            if r[0] == bro_intel_indicator_return.ERROR:
+                write_stderr('ERROR: %s' % (r[1]))
+                sys.exit(1)
+
+        if self.dedupe == 'last' and self.feed_file == STDIO_NAME:
+            write_stderr('ERROR: --dedupe last reads the feed twice and can not read it from stdin')
+            sys.exit(1)
+
+        if self.shard_by is not None and new_file == STDIO_NAME:
+            write_stderr('ERROR: --shard-by writes several files and can not write to stdout')
+            sys.exit(1)
+        if self.shard_by == 'hash' and self.shards < 1:
+            write_stderr('ERROR: --shards must be at least 1')
+            sys.exit(1)
+
+        suffix = b''.join(b'\t' + t for t in append_values) + b'\n'
+        written = 0
+        rejected = 0
+        index = 0
+        new_out = None
+        reject_out = None
+        complete = False
+        batches = self.__feed_batches(True)
+        writer = None
+        try:
+            for lines, flags, diagnostics in batches:
+                batch = []
+                for pos, l in enumerate(lines):
+                    if index == 0:
+                        if not self.__verify_header(index, l):
+                            self.__report_invalid_header(index)
+                            sys.exit(2)
+                        for k in append_fields:
+                            if self.header_exists(k):
+                                write_stderr('ERROR: %s already exists' % (k))
+                                sys.exit(1)
+                        key_index = self.__indicator_type_index if self.shard_by == 'type' else self.__indicator_index
+                        new_out = bro_intel_shard_writer(new_file,
+                                                         b''.join([l] + [b'\t' + as_bytes(k) for k in append_fields]) + b'\n',
+                                                         self.shard_by, self.shards, key_index, self.block_size)
+                        write = new_out.write
+                        if self.profile is not None:
+                            write = self.profile.wrap('stage', 'write', write)
+                        if self.__pipeline is not None:
+                            writer = self.__pipeline.writer(write)
+                            write = writer.put
+                        if reject_file is not None:
+                            reject_out = open_feed_output(reject_file, self.block_size)
+                            reject_out.write(l + b'\n')
+                        if self.dedupe == 'last':
+                            self.__index_last_occurrences()
+                        index += 1
+                        continue
+                    if flags is None:
+                        if self.__normalizers:
+                            l = self.__normalize_entry(l)
+                        ok = self.__verify_cached_entry(index, l)
+                    else:
+                        if pos in diagnostics:
+                            replay_diagnostics(diagnostics[pos], index - pos)
+                        ok = flags[pos]
+                    if ok:
+                        if not self.__is_tracking() or self.__track_entry(index, l):
+                            batch.append(l + suffix)
+                            written += 1
+                    elif reject_out is not None:
+                        reject_out.write(l + b'\n')
+                        rejected += 1
+                    elif self.collect_all:
+                        self.entries_rejected += 1
+                    else:
+                        sys.exit(3)
+                    index += 1
+                    if self.__is_capped():
+                        break
+                if batch:
+                    write(batch)
+                if self.__is_capped():
+                    break
+            if writer is not None:
+                writer.close()
+                writer = None
+            complete = not self.__is_capped()
+        finally:
+            batches.close()
+            if writer is not None:
+                writer.abort()
+            self.__save_cache(complete)
+            # A capped or failed run, or one that dropped bad entries, leaves
+            # no output behind
+            if new_out is not None:
+                if complete and not self.entries_rejected:
+                    new_out.close()
+                else:
+                    new_out.discard()
+            if reject_out is not None:
+                reject_out.close()
+
+        if index == 0:
+            self.__report_invalid_header(index)
+            sys.exit(2)
+        if not complete or self.entries_rejected:
+            self.entries_rejected = max(self.entries_rejected, 1)
+            return written, rejected
+        self.__report_overlaps()
+
+        if rejected:
+            write_stderr('%d of %d entries rejected to %s' % (rejected, written + rejected, reject_file))
+        if self.duplicates_dropped:
+            write_stderr('%d duplicate entries dropped' % (self.duplicates_dropped))
+        if self.allowlisted_dropped:
+            write_stderr('%d allowlisted entries dropped' % (self.allowlisted_dropped))
+        return written, rejected
+
+    def verify(self, header_only=False, jobs=1):
+        opened = self.__open_diagnostics()
+        start = _clock()
+        try:
+            self.__verify(header_only, jobs)
+        finally:
+            if opened:
+                self.__close_diagnostics()
+            self.__report_profile(start)
+        if self.allowlisted_dropped:
+            write_stderr('%d allowlisted entries dropped' % (self.allowlisted_dropped))
+        if self.entries_rejected:
+            sys.exit(3)
+
+    def __verify(self, header_only, jobs):
+        # Only the header line is read, not the first block of entries
+        if header_only:
+            l = bro_intel_feed_reader(self.feed_file).header()[0]
+            if l is not None and not self.__verify_header(0, l):
+                self.__report_invalid_header(0)
+                sys.exit(2)
+            return
+
+        # The verification cache is only consulted by the row path
+        if self.columnar and self.cache_file is None:
+            return self.verify_columnar()
+
+        if self.__pipeline is not None:
+            return self.__verify_pipelined()
+
+        # Cross-row checks span chunk boundaries, so they are only kept
+        # serially, and streamed feeds can not be split into byte ranges
+        if jobs is not None and jobs != 1 and self.cache_file is None and \
+                not (self.check_duplicates or self.check_overlaps) and \
+                not bro_intel_feed_reader(self.feed_file).is_stream():
+            return self.verify_parallel(jobs)
 
-    def verify(self, header_only=False):
+        complete = False
+        try:
+            for index, l in enumerate(self.load_feed(self.feed_file)):
+                # Check the header
+                if index == 0:
+                    if not self.__verify_header(index, l):
+                        self.__report_invalid_header(index)
+                        sys.exit(2)
+                else:
+                    if not self.__verify_cached_entry(index, l):
+                        self.__reject_entry()
+                    elif self.__is_tracking():
+                        self.__track_entry(index, l)
+                    if self.__is_capped():
+                        break
+            complete = not self.__is_capped()
+        finally:
+            self.__save_cache(complete)
+        self.__report_overlaps()
+
+    ##
+    # __verify() through the pipeline. Entries are verified by the pipeline's
+    # workers, while the diagnostics, the cross-row checks and the decision
+    # to stop are taken here in line order, exactly as the serial path does.
+    ##
+    def __verify_pipelined(self):
+        index = 0
+        batches = self.__feed_batches(False)
+        try:
+            for lines, flags, diagnostics in batches:
+                for pos, l in enumerate(lines):
+                    if index == 0:
+                        if not self.__verify_header(index, l):
+                            self.__report_invalid_header(index)
+                            sys.exit(2)
+                        index += 1
+                        continue
+                    if pos in diagnostics:
+                        replay_diagnostics(diagnostics[pos], index - pos)
+                    if not flags[pos]:
+                        self.__reject_entry()
+                    elif self.__is_tracking():
+                        self.__track_entry(index, l)
+                    index += 1
+                    if self.__is_capped():
+                        break
+                if self.__is_capped():
+                    break
+        finally:
+            batches.close()
+        self.__report_overlaps()
+
+    ##
+    # Locate the header line and the byte offset at which the feed body
+    # starts. Blank lines are skipped exactly as load_feed() does.
+    ##
+    def __find_body_offset(self):
+        return bro_intel_feed_reader(self.feed_file).header()
+
+    ##
+    # Split the feed body into byte ranges that start and end on line
+    # boundaries, so each can be verified independently.
+    ##
+    def __split_body(self, start, jobs):
+        end = os.path.getsize(self.feed_file)
+        chunk_size = max(self.min_chunk_size, (end - start) // (jobs * 4) + 1)
+        bounds = [start]
+        with open(self.feed_file, 'rb') as f:
+            pos = start + chunk_size
+            while pos < end:
+                f.seek(pos - 1)
+                f.readline()
+                pos = f.tell()
+                if pos >= end:
+                    break
+                bounds.append(pos)
+                pos += chunk_size
+        bounds.append(end)
+        return [(bounds[i], bounds[i+1]) for i in range(len(bounds) - 1)]
+
+    ##
+    # Verify the entries between byte offsets start and end. Returns the
+    # number of non-empty lines seen, the number of bad lines, the number of
+    # entries dropped as allowlisted, the diagnostics emitted along the way
+    # and the profile counters, if any.
+    # Unless collect_all is set, the first bad line ends the range. Indexes
+    # are relative to the first line of the chunk.
+    ##
+    def verify_range(self, start, end):
+        _diagnostics.capture = diagnostics = []
+        count = 0
+        failed = 0
+        allowlisted_dropped = self.allowlisted_dropped
+        try:
+            reader = bro_intel_feed_reader(self.feed_file, self.block_size, self.profile)
+            for lines in reader.blocks(start, end):
+                for t_line in lines:
+                    if not self.__verify_entry(count, t_line):
+                        failed += 1
+                        if not self.collect_all:
+                            count += 1
+                            break
+                    elif self.__allowlists:
+                        self.__track_entry(count, t_line)
+                    count += 1
+                if failed and not self.collect_all:
+                    break
+        finally:
+            _diagnostics.capture = None
+        counters = self.profile.take() if self.profile is not None else None
+        return count, failed, self.allowlisted_dropped - allowlisted_dropped, diagnostics, counters
+
+    ##
+    # Verify a batch of entries for the pipeline, normalized first if
+    # normalize is set, as append() does. Returns the entries as verified,
+    # one flag per entry and the diagnostics of each entry by position in the
+    # batch. Every entry is verified; it is up to the caller to stop at the
+    # first bad one.
+    ##
+    def verify_batch(self, lines, normalize=True):
+        _diagnostics.capture = captured = []
+        out = []
+        flags = []
+        diagnostics = {}
+        try:
+            for pos, l in enumerate(lines):
+                if normalize and self.__normalizers:
+                    l = self.__normalize_entry(l)
+                out.append(l)
+                flags.append(self.__verify_entry(pos, l))
+                if captured:
+                    diagnostics[pos] = list(captured)
+                    del captured[:]
+        finally:
+            _diagnostics.capture = None
+        return out, flags, diagnostics
+
+    ##
+    # Batches of the feed as (lines, flags, diagnostics), see verify_batch().
+    # Without a pipeline, or for the header, which comes first on its own,
+    # flags and diagnostics are None and the lines are left to the caller to
+    # verify. The pipeline is only set up once the caller has taken the
+    # header, and so verified it. Entries are only normalized with normalize
+    # set, for append(); verify leaves them as they are, as on the serial path.
+    ##
+    def __feed_batches(self, normalize):
+        if self.__pipeline is None:
+            for lines in self.load_feed_blocks(self.feed_file):
+                yield lines, None, None
+            return
+
+        pipeline = self.__pipeline
+        batches = pipeline.read(pipeline.rebatch(self.load_feed_blocks(self.feed_file)))
+        try:
+            first = next(batches, None)
+            if first is None:
+                return
+            yield first[:1], None, None
+
+            options = _worker_options(self.feed_file, self.collect_all, self.profile is not None,
+                                      self.public_suffix_list, None, None,
+                                      normalize and self.normalize_domains,
+                                      normalize and self.normalize_hashes)
+            for lines, flags, diagnostics, counters in pipeline.validate(
+                    itertools.chain([first[1:]], batches),
+                    lambda lines: self.verify_batch(lines, normalize) + (None,),
+                    _verify_batch_worker, _init_verify_worker, (options, first[0])):
+                if counters:
+                    self.profile.merge(counters)
+                yield lines, flags, diagnostics
+        finally:
+            batches.close()
+
+    def load_header(self, l):
+        _diagnostics.capture = []
+        try:
+            return self.__verify_header(0, l)
+        finally:
+            _diagnostics.capture = None
+
+    def verify_parallel(self, jobs=0):
+        if jobs is None or jobs < 1:
+            jobs = multiprocessing.cpu_count()
+
+        header, body_offset = self.__find_body_offset()
+        if header is None or not self.__verify_header(0, header):
+            self.__report_invalid_header(0)
+            sys.exit(2)
+
+        ranges = self.__split_body(body_offset, jobs)
+        if self.__diagnostics is not None:
+            self.__diagnostics.flush()
+        options = _worker_options(self.feed_file, self.collect_all, self.profile is not None,
+                                  self.public_suffix_list, self.allowlist_files, self.allowlist_action)
+        pool = multiprocessing.Pool(min(jobs, len(ranges)), _init_verify_worker, (options, header))
+        try:
+            # The header is line 0, entries are numbered from 1
+            offset = 1
+            for count, failed, dropped, diagnostics, counters in pool.imap(_verify_range_worker,
+                                                                           ranges):
+                self.allowlisted_dropped += dropped
+                replay_diagnostics(diagnostics, offset)
+                if counters:
+                    self.profile.merge(counters)
+                if failed:
+                    self.__reject_entry(failed)
+                if self.__is_capped():
+                    break
+                offset += count
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    ##
+    # Verify the header and yield every entry of the feed that passes
+    # verification. A bad entry stops the run unless drop_invalid is set, in
+    # which case it is reported, counted in entries_rejected and left out.
+    ##
+    def verified_entries(self, drop_invalid=False):
         for index, l in enumerate(self.load_feed(self.feed_file)):
-            # Check the header
             if index == 0:
                 if not self.__verify_header(index, l):
-                    warning_line(index, "Invalid header")
+                    self.__report_invalid_header(index)
                     sys.exit(2)
-            elif header_only is True:
-                break
+                continue
+            if self.__normalizers:
+                l = self.__normalize_entry(l)
+            if self.__verify_entry(index, l):
+                if not self.__is_tracking() or self.__track_entry(index, l):
+                    yield l
+            elif drop_invalid:
+                self.entries_rejected += 1
             else:
-                if not self.__verify_entry(index, l):
-                    sys.exit(3)
+                sys.exit(3)
+
+        if not self.__feed_header_found:
+            self.__report_invalid_header(0)
+            sys.exit(2)
 
     def header_exists(self, entry):
         return entry in self.header_fields
 
-def populate_existing_bro_feed(options):
-    if options.feed_file is not None and os.path.exists(options.feed_file):
 
-        new_out = open(options.new_file, 'w')
-        for index, l in enumerate(bifv.load_feed(options.feed_file)):
-            # Check the header
-            t_out = l
-            if index == 0:
-                if options.meta_desc is not None:
-                    t_out += '\tmeta.desc'
+##
+# Column names of a #fields header line of feed. Exits if the line is not a
+# #fields header.
+##
+def header_line_fields(l, feed):
+    contents = [as_text(t) for t in l.split(b'\t')] if l is not None else []
+    if len(contents) < 2 or contents[0] != bro_intel_feed_verifier.field_header_designator:
+        write_stderr('ERROR: No #fields header found in %s' % (feed))
+        sys.exit(2)
+    return contents[1:]
 
-                if options.meta_severity is not None:
-                    t_out += '\tmeta.severity'
-            else:
-                if options.meta_desc is not None:
-                    t_out += '\t' + options.meta_desc
 
-                if options.meta_severity is not None:
-                    t_out += '\t' + str(options.meta_severity)
+##
+# Column names of the #fields header of feed, read without reading the body
+##
+def feed_header_fields(feed):
+    header, body_offset = bro_intel_feed_reader(feed).header()
+    return header_line_fields(header, feed)
 
-            new_out.write(t_out + '\n')
-        new_out.close()
 
 ###############################################################################
-# main()
+# class bro_intel_feed_merger
+#
+# Combines feeds with differing headers into one. The unified header starts
+# with indicator and indicator_type, followed by every other column in the
+# order it is first seen. Each feed is verified on its own, its entries are
+# remapped onto the unified header with absent columns filled in, and the
+# result is sorted by (indicator, indicator_type) with an external sort so
+# memory stays bounded. Of entries sharing an (indicator, indicator_type)
+# the one from the earliest feed, and earliest line, is kept.
+#
+class bro_intel_feed_merger:
+    lead_fields = ['indicator', 'indicator_type']
+
+    def __init__(self, options, feeds):
+        self.options = options
+        self.feeds = feeds
+        self.new_file = options.new_file
+        self.drop_invalid = getattr(options, 'drop_invalid', False)
+        self.sort_buffer = getattr(options, 'sort_buffer', 64) << 20
+        self.tmp_dir = getattr(options, 'tmp_dir', None)
+        self.fill = {}
+        for t in getattr(options, 'fill', None) or []:
+            k, sep, v = t.partition('=')
+            if not sep:
+                write_stderr('ERROR: --fill takes COLUMN=VALUE, not %s' % (t))
+                sys.exit(1)
+            self.fill[k] = as_bytes(v)
+        self.header_fields = []
+        self.duplicates_dropped = 0
+        self.allowlisted_dropped = 0
+        self.entries_rejected = 0
+        self.__validator = bro_data_intel_field_values()
+
+    ##
+    # Build the unified header and check that every column a feed lacks can
+    # be filled in with a valid value.
+    ##
+    def __unify_headers(self):
+        feed_fields = [feed_header_fields(feed) for feed in self.feeds]
+        self.header_fields = list(self.lead_fields)
+        for fields in feed_fields:
+            for k in fields:
+                if k not in self.header_fields:
+                    self.header_fields.append(k)
+
+        for feed, fields in zip(self.feeds, feed_fields):
+            for k in self.header_fields:
+                if k in fields or k in self.lead_fields:
+                    continue
+                v = self.fill.setdefault(k, bro_data_intel_field_values.EMPTY_FIELD_CHAR)
+                r = self.__validator.get_verifier(k)(v)
+                if r[0] == bro_intel_indicator_return.ERROR:
+                    write_stderr('ERROR: Column %s is missing from %s and \"%s\" is not valid for it, set one with --fill %s=VALUE' %
+                                 (k, feed, as_text(v), k))
+                    sys.exit(1)
+        return feed_fields
+
+    ##
+    # Verify a feed and add its entries to the sort as
+    # "indicator<TAB>indicator_type<TAB>sequence<TAB>other columns", which
+    # sorts by key and then input order since fields can not contain tabs.
+    ##
+    def __add_feed(self, sort, feed, fields, seq):
+        i_indicator = fields.index('indicator')
+        i_type = fields.index('indicator_type')
+        positions = [fields.index(k) if k in fields else None
+                     for k in self.header_fields[len(self.lead_fields):]]
+        fills = [self.fill.get(k) for k in self.header_fields[len(self.lead_fields):]]
+
+        options = copy.copy(self.options)
+        options.feed_file = feed
+        bifv = bro_intel_feed_verifier(options)
+        for l in bifv.verified_entries(self.drop_invalid):
+            c = l.split(b'\t')
+            rest = b'\t'.join([c[p] if p is not None else v for p, v in zip(positions, fills)])
+            sort.add(b'%s\t%s\t%012d\t%s' % (c[i_indicator], c[i_type], seq, rest))
+            seq += 1
+        self.entries_rejected += bifv.entries_rejected
+        self.allowlisted_dropped += bifv.allowlisted_dropped
+        return seq
+
+    def merge(self):
+        feed_fields = self.__unify_headers()
+        sort = bro_intel_external_sort(self.sort_buffer, self.tmp_dir)
+        written = 0
+        try:
+            seq = 0
+            for feed, fields in zip(self.feeds, feed_fields):
+                write_stderr('Merging %s' % (feed))
+                seq = self.__add_feed(sort, feed, fields, seq)
+
+            last = None
+            with open_feed_output(self.new_file, bro_intel_feed_verifier.block_size) as out:
+                out.write(b'\t'.join(as_bytes(k) for k in [bro_intel_feed_verifier.field_header_designator] +
+                                      self.header_fields) + b'\n')
+                for l in sort:
+                    indicator, indicator_type, seq, rest = l.split(b'\t', 3)
+                    key = (indicator, indicator_type)
+                    if key == last:
+                        self.duplicates_dropped += 1
+                        continue
+                    last = key
+                    out.write(b'%s\t%s\t%s' % (indicator, indicator_type, rest))
+                    written += 1
+        finally:
+            sort.close()
+
+        if self.entries_rejected:
+            write_stderr('%d invalid entries dropped' % (self.entries_rejected))
+        if self.duplicates_dropped:
+            write_stderr('%d duplicate entries dropped' % (self.duplicates_dropped))
+        if self.allowlisted_dropped:
+            write_stderr('%d allowlisted entries dropped' % (self.allowlisted_dropped))
+        return written
+
 ###############################################################################
-def main():
-    parser = OptionParser()
-    parser.add_option('-f', '--file',    dest='feed_file', help='Bro Intel Feed to Append')
-    parser.add_option('-n', '--new',     dest='new_file',  help='File to write appended feed data')
-    parser.add_option('--meta-desc',     dest='meta_desc',  help='Verify Intel meets PacketSled requirements')
-    parser.add_option('--meta-severity', dest='meta_severity', type='int', help='Warn ONLY on errors, continue processing and report')
-    (options, args) = parser.parse_args()
-
-    if len(sys.argv) < 4:
-        parser.print_help()
+# class bro_intel_feed_differ
+#
+# Compares two versions of a feed by (indicator, indicator_type) and writes
+# the entries that were added, removed or modified as feeds of their own, for
+# incremental updates. Both feeds must have the same columns, in any order;
+# the old feed's entries are remapped onto the new feed's header. Each feed
+# is verified and sorted by key with an external sort, then the two sorted
+# streams are walked side by side, so memory stays bounded whatever the feed
+# sizes. Of entries sharing a key within one feed the first is used. Added
+# and modified entries are written as they are in the new feed, removed ones
+# as they were in the old.
+#
+class bro_intel_feed_differ:
+    def __init__(self, options, old_feed, new_feed):
+        self.options = options
+        self.old_feed = old_feed
+        self.new_feed = new_feed
+        self.added_file = getattr(options, 'added_file', None)
+        self.removed_file = getattr(options, 'removed_file', None)
+        self.modified_file = getattr(options, 'modified_file', None)
+        self.drop_invalid = getattr(options, 'drop_invalid', False)
+        self.sort_buffer = getattr(options, 'sort_buffer', 64) << 20
+        self.tmp_dir = getattr(options, 'tmp_dir', None)
+        self.header_fields = []
+        self.added = 0
+        self.removed = 0
+        self.modified = 0
+        self.unchanged = 0
+        self.duplicates_dropped = 0
+        self.entries_rejected = 0
+
+    ##
+    # Verify a feed and add its entries, with their columns in the order
+    # given by positions if set, to the sort as
+    # "indicator<TAB>indicator_type<TAB>sequence<TAB>entry".
+    ##
+    def __add_feed(self, sort, feed, fields, positions=None):
+        i_indicator = fields.index('indicator')
+        i_type = fields.index('indicator_type')
+
+        options = copy.copy(self.options)
+        options.feed_file = feed
+        bifv = bro_intel_feed_verifier(options)
+        for seq, l in enumerate(bifv.verified_entries(self.drop_invalid)):
+            c = l.split(b'\t')
+            if positions is not None:
+                l = b'\t'.join([c[p] for p in positions])
+            sort.add(b'%s\t%s\t%012d\t%s' % (c[i_indicator], c[i_type], seq, l))
+        self.entries_rejected += bifv.entries_rejected
+
+    ##
+    # Yields ((indicator, indicator_type), newline terminated entry) from a
+    # sort filled by __add_feed(), first entry per key only.
+    ##
+    def __entries(self, sort):
+        last = None
+        for l in sort:
+            indicator, indicator_type, seq, entry = l.split(b'\t', 3)
+            key = (indicator, indicator_type)
+            if key == last:
+                self.duplicates_dropped += 1
+                continue
+            last = key
+            yield key, entry
+
+    def diff(self):
+        old_fields = feed_header_fields(self.old_feed)
+        new_fields = feed_header_fields(self.new_feed)
+        if sorted(old_fields) != sorted(new_fields):
+            write_stderr('ERROR: %s and %s have different columns' % (self.old_feed, self.new_feed))
+            sys.exit(1)
+        self.header_fields = new_fields
+
+        old_sort = bro_intel_external_sort(self.sort_buffer, self.tmp_dir)
+        new_sort = bro_intel_external_sort(self.sort_buffer, self.tmp_dir)
+        outs = []
+        try:
+            write_stderr('Reading %s' % (self.old_feed))
+            self.__add_feed(old_sort, self.old_feed, old_fields,
+                            [old_fields.index(k) for k in new_fields])
+            write_stderr('Reading %s' % (self.new_feed))
+            self.__add_feed(new_sort, self.new_feed, new_fields)
+
+            header = b'\t'.join(as_bytes(k) for k in
+                                [bro_intel_feed_verifier.field_header_designator] + new_fields) + b'\n'
+            writes = []
+            for path in (self.added_file, self.removed_file, self.modified_file):
+                if path is None:
+                    writes.append(lambda entry: None)
+                    continue
+                out = open_feed_output(path, bro_intel_feed_verifier.block_size)
+                outs.append(out)
+                out.write(header)
+                writes.append(out.write)
+            add, remove, modify = writes
+
+            old_entries = self.__entries(old_sort)
+            new_entries = self.__entries(new_sort)
+            old = next(old_entries, None)
+            new = next(new_entries, None)
+            while old is not None or new is not None:
+                if new is None or (old is not None and old[0] < new[0]):
+                    remove(old[1])
+                    self.removed += 1
+                    old = next(old_entries, None)
+                elif old is None or new[0] < old[0]:
+                    add(new[1])
+                    self.added += 1
+                    new = next(new_entries, None)
+                else:
+                    if old[1] != new[1]:
+                        modify(new[1])
+                        self.modified += 1
+                    else:
+                        self.unchanged += 1
+                    old = next(old_entries, None)
+                    new = next(new_entries, None)
+        finally:
+            for out in outs:
+                out.close()
+            old_sort.close()
+            new_sort.close()
+
+        if self.entries_rejected:
+            write_stderr('%d invalid entries dropped' % (self.entries_rejected))
+        if self.duplicates_dropped:
+            write_stderr('%d duplicate entries dropped' % (self.duplicates_dropped))
+        write_stderr('%d added, %d removed, %d modified, %d unchanged' %
+                     (self.added, self.removed, self.modified, self.unchanged))
+        return self.added, self.removed, self.modified
+
+###############################################################################
+# class bro_intel_feed_stats
+#
+# Summary of a feed without verifying it: the number of entries, how many of
+# them do not have as many fields as the header, and entries per
+# indicator_type and per meta.source. The feed is read a block at a time,
+# compressed or not, exactly as the verifier reads it.
+#
+class bro_intel_feed_stats:
+    formats = ['table', 'json']
+    count_fields = ['indicator_type', 'meta.source']
+
+    def __init__(self, feed):
+        self.feed = feed
+        self.header_fields = []
+        self.entries = 0
+        self.malformed = 0
+        self.counts = dict((k, {}) for k in self.count_fields)
+        self.__columns = []
+
+    def __load_header(self, l):
+        self.header_fields = header_line_fields(l, self.feed)
+        self.__columns = [(self.counts[k], self.header_fields.index(k))
+                          for k in self.count_fields if k in self.header_fields]
+
+    def __count(self, lines):
+        n = len(self.header_fields)
+        self.entries += len(lines)
+        for l in lines:
+            t = l.split(b'\t')
+            if len(t) != n:
+                self.malformed += 1
+                continue
+            for counts, i in self.__columns:
+                counts[t[i]] = counts.get(t[i], 0) + 1
+
+    def collect(self):
+        header = False
+        for lines in bro_intel_feed_reader(self.feed).blocks():
+            if not header and lines:
+                self.__load_header(lines[0])
+                lines = lines[1:]
+                header = True
+            self.__count(lines)
+        if not header:
+            write_stderr('ERROR: No #fields header found in %s' % (self.feed))
+            sys.exit(2)
+        return self
+
+    # Most frequent first
+    def __rows(self, k):
+        return sorted(self.counts[k].items(), key=lambda item: (-item[1], item[0]))
+
+    def format_table(self):
+        out = ['%-16s %-40s %12s' % ('column', 'value', 'entries'),
+               '%-16s %-40s %12d' % ('', 'total', self.entries),
+               '%-16s %-40s %12d' % ('', 'malformed', self.malformed)]
+        for k in self.count_fields:
+            for v, count in self.__rows(k):
+                out.append('%-16s %-40s %12d' % (k, as_text(v), count))
+        return '\n'.join(out) + '\n'
+
+    def format_json(self):
+        summary = {'fields': self.header_fields,
+                   'entries': self.entries,
+                   'malformed': self.malformed}
+        for k in self.count_fields:
+            if k in self.header_fields:
+                summary[k] = dict((as_text(v), count) for v, count in self.counts[k].items())
+        return json.dumps(summary, sort_keys=True) + '\n'
+
+    def report(self, out, fmt='table'):
+        if fmt == 'json':
+            out.write(self.format_json())
+        else:
+            out.write(self.format_table())
+
+
+###############################################################################
+# Parallel verification workers
+#
+# Each worker process builds its own bro_intel_feed_verifier from the already
+# validated header line and then verifies the byte ranges it is handed.
+#
+_worker_verifier = None
+
+
+class _worker_options:
+    def __init__(self, feed_file, collect=False, profile=False, public_suffix_list=None,
+                 allowlist=None, allowlist_action=None, normalize_domains=False,
+                 normalize_hashes=False):
+        self.feed_file = feed_file
+        self.collect = collect
+        self.profile = profile
+        self.public_suffix_list = public_suffix_list
+        self.allowlist = allowlist
+        self.allowlist_action = allowlist_action
+        self.normalize_domains = normalize_domains
+        self.normalize_hashes = normalize_hashes
+
+
+def _init_verify_worker(options, header):
+    global _worker_verifier
+    _worker_verifier = bro_intel_feed_verifier(options)
+    _worker_verifier.load_header(header)
+
+
+def _verify_range_worker(r):
+    return _worker_verifier.verify_range(*r)
+
+
+def _verify_batch_worker(lines):
+    profile = _worker_verifier.profile
+    return _worker_verifier.verify_batch(lines) + (profile.take() if profile is not None else None,)
+
+
+###############################################################################
+# Verification daemon
+#
+# A long running server on a Unix domain socket that keeps one warm
+# bro_data_intel_field_values for every request. Each connection carries one
+# or more requests, a JSON object on a line of its own:
+#
+#   {"op": "verify", "path": FEED, ...}     verify a feed on disk
+#   {"op": "verify", "length": N, ...}      verify the N byte feed that follows
+#   {"op": "ping"}
+#   {"op": "shutdown"}
+#
+# verify also takes columnar, duplicates, overlaps, max_errors, cache and
+# header_only, as on the command line. The reply to verify is the collected
+# diagnostics as JSON Lines, their summary, and then a result object with
+# status ok, error, invalid_header or rejected; other requests are answered
+# with a result object alone. Requests are served by one thread each.
+#
+class _daemon_options:
+    def __init__(self, feed_file, request, out, public_suffix_list=None):
+        self.feed_file = feed_file
+        self.collect = True
+        self.diagnostics_out = out
+        self.max_errors = request.get('max_errors', None)
+        self.columnar = request.get('columnar', False)
+        self.duplicates = request.get('duplicates', False)
+        self.overlaps = request.get('overlaps', False)
+        self.cache_file = request.get('cache', None)
+        self.public_suffix_list = public_suffix_list
+
+
+##
+# The daemon's classes derive from socketserver's, so they are only defined,
+# and socketserver imported, once a daemon is started. Returns the server.
+##
+def _define_verify_daemon():
+    global bro_intel_verify_handler, bro_intel_verify_server
+
+    class bro_intel_verify_handler(socketserver.StreamRequestHandler):
+        exit_status = {0: 'ok',
+                       1: 'error',
+                       2: 'invalid_header',
+                       3: 'rejected'}
+
+        def __reply(self, result):
+            self.wfile.write(json.dumps(result, sort_keys=True).encode('ascii') + b'\n')
+            self.wfile.flush()
+
+        def handle(self):
+            while True:
+                l = self.rfile.readline()
+                if not l:
+                    break
+                try:
+                    request = json.loads(l.decode('utf-8'))
+                    if not isinstance(request, dict):
+                        raise ValueError('request is not an object')
+                except ValueError as e:
+                    self.__reply({'status': 'error', 'message': 'Invalid request - %s' % (e)})
+                    break
+
+                op = request.get('op', None)
+                if op == 'verify':
+                    if not self.__verify(request):
+                        break
+                elif op == 'ping':
+                    self.__reply({'status': 'ok', 'requests': self.server.requests})
+                elif op == 'shutdown':
+                    self.__reply({'status': 'ok'})
+                    self.server.request_shutdown()
+                    break
+                else:
+                    self.__reply({'status': 'error', 'message': 'Unknown op - %s' % (op)})
+
+        ##
+        # A streamed body is spooled to a temporary file first so that it is
+        # read in full, and the connection stays in step, however verification
+        # ends. Returns False if the connection can not be used any further.
+        ##
+        def __verify(self, request):
+            self.server.requests += 1
+            body = None
+            try:
+                if 'length' in request:
+                    length = int(request['length'])
+                    body = tempfile.NamedTemporaryFile(prefix='pipp-body-', dir=self.server.tmp_dir,
+                                                       delete=False)
+                    while length > 0:
+                        data = self.rfile.read(min(length, 1 << 16))
+                        if not data:
+                            body.close()
+                            return False
+                        body.write(data)
+                        length -= len(data)
+                    body.close()
+                    feed = body.name
+                else:
+                    feed = request.get('path', None)
+                    if feed is None or not os.path.exists(feed):
+                        self.__reply({'status': 'error', 'message': 'Feed file not found - %s' % (feed)})
+                        return True
+
+                bifv = bro_intel_feed_verifier(_daemon_options(feed, request, self.wfile,
+                                                                  self.server.public_suffix_list),
+                                               self.server.validator)
+                start = _clock()
+                try:
+                    bifv.verify(header_only=request.get('header_only', False))
+                    code = 0
+                except SystemExit as e:
+                    code = e.code if isinstance(e.code, int) else 1
+                except Exception as e:
+                    self.__reply({'status': 'error', 'message': str(e)})
+                    return True
+                self.__reply({'status': self.exit_status.get(code, 'error'),
+                              'exit': code,
+                              'seconds': _clock() - start})
+                return True
+            finally:
+                if body is not None:
+                    os.unlink(body.name)
+
+
+    class bro_intel_verify_server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        # In-flight requests are finished before the process exits
+        daemon_threads = False
+
+        def __init__(self, path, tmp_dir=None, public_suffix_list=None):
+            self.path = path
+            self.tmp_dir = tmp_dir
+            self.public_suffix_list = public_suffix_list
+            self.requests = 0
+            public_suffixes = None
+            if public_suffix_list is not None:
+                public_suffixes = load_public_suffixes(public_suffix_list)
+            self.validator = bro_data_intel_field_values(public_suffixes=public_suffixes)
+            socketserver.UnixStreamServer.__init__(self, path, bro_intel_verify_handler)
+
+        ##
+        # shutdown() waits for serve_forever() to return, so it is called from a
+        # thread of its own. Safe to call from a signal handler.
+        ##
+        def request_shutdown(self):
+            t = threading.Thread(target=self.shutdown)
+            t.daemon = True
+            t.start()
+
+        ##
+        # Remove a socket left behind by a daemon that is no longer running.
+        # Returns False if a daemon is still listening on path.
+        ##
+        @staticmethod
+        def remove_stale_socket(path):
+            if not os.path.exists(path):
+                return True
+            s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                s.connect(path)
+                return False
+            except socket.error:
+                os.unlink(path)
+                return True
+            finally:
+                s.close()
+
+
+    return bro_intel_verify_server
+
+
+###############################################################################
+# Command line
+#
+# pipp.py COMMAND [options], COMMAND being one of COMMANDS. Only the parser of
+# the command that is run is built. The flag style of earlier releases,
+# pipp.py -f FEED -n NEW_FILE and pipp.py --verify -f FEED, still runs as
+# append and verify. verify --header-only FEED is parsed by hand so that a
+# header check does not even import argparse.
+#
+argparse = _lazy_import('argparse')
+
+
+def _command_parser(command, usage, description=None):
+    prog = os.path.basename(sys.argv[0])
+    if command is not None:
+        prog = '%s %s' % (prog, command)
+    return argparse.ArgumentParser(prog=prog, usage=usage, description=description)
+
+
+def _add_feed_options(parser):
+    parser.add_argument('feed', nargs='?', metavar='FEED',
+                        help='Same as -f FEED')
+    parser.add_argument('-f', '--file',    dest='feed_file',
+                        help='Bro Intel Feed, optionally gzip/bzip2/xz compressed (- for stdin)')
+    # Accepted, and implied, for the flag style command line
+    parser.add_argument('--verify',        dest='verify', action='store_true', default=False,
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--columnar',      dest='columnar', action='store_true', default=False,
+                        help='Verify entries a block of columns at a time')
+    parser.add_argument('--duplicates',    dest='duplicates', action='store_true', default=False,
+                        help='Report duplicate and conflicting indicator/indicator_type entries')
+    parser.add_argument('--overlaps',      dest='overlaps', action='store_true', default=False,
+                        help='Report Intel::ADDR entries covered by an Intel::NET and overlapping Intel::NETs')
+    parser.add_argument('--pipeline',      dest='pipeline', action='store_true', default=False,
+                        help='Read, verify and write in separate stages connected by bounded queues')
+    parser.add_argument('--workers',       dest='workers', type=int, default=1,
+                        help='Processes in the --pipeline verify stage (0 = verify in the main process)')
+    parser.add_argument('--queue-depth',   dest='queue_depth', type=int, default=4,
+                        help='Batches queued between --pipeline stages (default: 4)')
+    parser.add_argument('--batch-size',    dest='batch_size', type=int, default=2000,
+                        help='Entries per --pipeline batch (default: 2000)')
+    parser.add_argument('--cache',         dest='cache_file',
+                        help='Skip entries that passed on an earlier run, as recorded in this cache file')
+    parser.add_argument('--collect',       dest='collect', action='store_true', default=False,
+                        help='Keep going past bad entries and report every problem as JSON Lines')
+    parser.add_argument('--max-errors',    dest='max_errors', type=int,
+                        help='Stop collecting after this many errors (implies --collect)')
+    parser.add_argument('--diagnostics',   dest='diagnostics_file',
+                        help='Write collected diagnostics to this file instead of stdout')
+    parser.add_argument('--public-suffix-list', dest='public_suffix_list',
+                        help='Also check Intel::DOMAIN entries against this public suffix list')
+    parser.add_argument('--normalize-domains', dest='normalize_domains', action='store_true', default=False,
+                        help='Lowercase Intel::DOMAIN and Intel::URL hosts, strip trailing dots and convert IDNs to punycode')
+    parser.add_argument('--normalize-hashes', dest='normalize_hashes', action='store_true', default=False,
+                        help='Lowercase Intel::FILE_HASH and Intel::CERT_HASH values and strip fingerprint colons')
+    parser.add_argument('--allowlist',     dest='allowlist', action='append', metavar='FILE',
+                        help='Flag or drop entries whose indicator is listed in FILE, compiled once to FILE%s' % (ALLOWLIST_SUFFIX))
+    parser.add_argument('--allowlist-action', dest='allowlist_action',
+                        choices=bro_intel_feed_verifier.allowlist_actions, default='flag',
+                        help='What to do with allowlisted entries: flag (warn) or drop')
+    parser.add_argument('--tmp-dir',       dest='tmp_dir',
+                        help='Directory for allowlists that can not be compiled next to their source')
+    parser.add_argument('--profile',       dest='profile', action='store_true', default=False,
+                        help='Report call counts, time and fail rates per stage, verifier and handler on stderr')
+    parser.add_argument('--profile-format', dest='profile_format',
+                        choices=bro_intel_profile.formats, default='table',
+                        help='Profile report format: table or prometheus')
+
+
+def _add_verify_options(parser):
+    parser.add_argument('-j', '--jobs',    dest='jobs', type=int, default=1,
+                        help='Number of processes used to verify entries (0 = all cores)')
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--header-only',    dest='header_only', action='store_true', default=False,
+                       help='Only verify the #fields header')
+    group.add_argument('--compile',        dest='compile_file',
+                       help='After a successful verify, write a compiled copy of the feed here (skipped while it is current)')
+
+
+def _add_append_options(parser):
+    parser.add_argument('-n', '--new',     dest='new_file',
+                        help='File to write appended feed data, compressed by a .gz/.bz2/.xz extension (- for stdout)')
+    parser.add_argument('--meta-desc',     dest='meta_desc',
+                        help='Value of the meta.desc column added to every entry')
+    parser.add_argument('--meta-severity', dest='meta_severity', type=int,
+                        help='Value of the meta.severity column added to every entry')
+    parser.add_argument('--dedupe',        dest='dedupe',
+                        choices=bro_intel_feed_verifier.dedupe_modes,
+                        help='Drop duplicate entries from the new feed, keeping the first or last one')
+    parser.add_argument('--shard-by',      dest='shard_by',
+                        choices=bro_intel_shard_writer.shard_modes,
+                        help='Split the new feed into one file per indicator type, or into --shards files by a hash of the indicator')
+    parser.add_argument('--shards',        dest='shards', type=int, default=4,
+                        help='Number of files written by --shard-by hash (default: 4)')
+    parser.add_argument('--reject-file',   dest='reject_file',
+                        help='Write bad entries here and keep going instead of stopping at the first one')
+
+
+def _parse_feed_options(parser, argv):
+    options = parser.parse_args(argv)
+    if options.feed is not None:
+        if options.feed_file is not None:
+            parser.error('give the feed either as FEED or with -f, not both')
+        options.feed_file = options.feed
+    return options
+
+
+def _check_feed_file(options):
+    if options.feed_file is None or \
+            (options.feed_file != STDIO_NAME and not os.path.exists(options.feed_file)):
+        print('ERROR: Feed file not found - %s' % (options.feed_file))
         sys.exit(1)
 
-    bifv = bro_intel_feed_verifier(options)
-    bifv.verify(header_only=True)
 
+def appended_columns(options):
+    fields = []
+    values = []
     if options.meta_desc is not None:
-        if bifv.header_exists('meta.desc') is True:
-            print 'ERROR: meta.desc already exists'
-            sys.exit(1)
+        fields.append('meta.desc')
+        values.append(as_bytes(options.meta_desc))
 
     if options.meta_severity is not None:
-        if bifv.header_exists('meta.severity') is True:
-            print 'ERROR: meta.desc already exists'
+        fields.append('meta.severity')
+        values.append(as_bytes(str(options.meta_severity)))
+    return fields, values
+
+
+def populate_existing_bro_feed(options):
+    if options.feed_file == STDIO_NAME or (options.feed_file is not None and os.path.exists(options.feed_file)):
+        bifv = bro_intel_feed_verifier(options)
+        fields, values = appended_columns(options)
+        return bifv.append(options.new_file, fields, values,
+                           reject_file=getattr(options, 'reject_file', None))
+
+def verify_feed(options):
+    _check_feed_file(options)
+    if options.compile_file is not None:
+        if options.feed_file == STDIO_NAME:
+            print('ERROR: --compile needs a feed file, not stdin')
             sys.exit(1)
+        if not any(getattr(options, k, None) for k in COMPILED_UNVOUCHED_OPTIONS) and \
+                compiled_feed_is_current(options.compile_file, options.feed_file):
+            sys.exit(0)
+    before = _diagnostics.count
+    bro_intel_feed_verifier(options).verify(header_only=options.header_only, jobs=options.jobs)
+    if options.compile_file is not None:
+        bro_intel_compiled_feed.compile(options.feed_file, options.compile_file,
+                                        options.tmp_dir, diagnostics=_diagnostics.count - before)
+    sys.exit(0)
 
+def verify_main(argv):
+    parser = _command_parser('verify', '%(prog)s [options] [-f] FEED',
+                             'Verify the header and every entry of a feed.')
+    _add_feed_options(parser)
+    _add_verify_options(parser)
+    verify_feed(_parse_feed_options(parser, argv))
+
+def append_feed(parser, options):
     if options.new_file is None:
-        print 'ERROR: Please supply a --new/-n file argument'
+        print('ERROR: Please supply a --new/-n file argument')
         parser.print_help()
         sys.exit(1)
+    _check_feed_file(options)
+    populate_existing_bro_feed(options)
 
-    if options.feed_file is not None and os.path.exists(options.feed_file):
+def append_main(argv):
+    parser = _command_parser('append', '%(prog)s -n NEW_FILE [options] [-f] FEED',
+                             'Verify a feed and write it out with the meta columns added.')
+    _add_feed_options(parser)
+    _add_append_options(parser)
+    append_feed(parser, _parse_feed_options(parser, argv))
 
-        new_out = open(options.new_file, 'w')
-        for index, l in enumerate(bifv.load_feed(options.feed_file)):
-            # Check the header
-            t_out = l
-            if index == 0:
-                if options.meta_desc is not None:
-                    t_out += '\tmeta.desc'
+##
+# verify --header-only [-f] FEED, the check run before a feed is picked up,
+# without argparse. Returns for any other command line, which is then parsed
+# in full.
+##
+def header_only_main(argv):
+    if argv[:1] != ['verify'] or '--header-only' not in argv:
+        return
+    args = [t for t in argv[1:] if t != '--header-only']
+    if len(args) == 2 and args[0] in ('-f', '--file'):
+        feed = args[1]
+    elif len(args) == 1 and not args[0].startswith('-'):
+        feed = args[0]
+    else:
+        return
+    if not os.path.exists(feed):
+        return
+    # The defaults of _worker_options are those of the command line
+    bro_intel_feed_verifier(_worker_options(feed)).verify(header_only=True)
+    sys.exit(0)
 
-                if options.meta_severity is not None:
-                    t_out += '\tmeta.severity'
-            else:
-                if options.meta_desc is not None:
-                    t_out += '\t' + options.meta_desc
+##
+# The flag style command line: append with -n, verify with --verify alone.
+##
+def legacy_main(argv):
+    parser = _command_parser(None, '%(prog)s COMMAND [options]\n'
+                             '       %(prog)s -f FEED (-n NEW_FILE | --verify) [options]',
+                             'Commands: %s. Run %s COMMAND --help for the options of each.' %
+                             (', '.join(sorted(COMMANDS)), os.path.basename(sys.argv[0])))
+    _add_feed_options(parser)
+    _add_verify_options(parser)
+    _add_append_options(parser)
+    if len(argv) < 3:
+        parser.print_help()
+        sys.exit(1)
+
+    options = _parse_feed_options(parser, argv)
+    if options.new_file is None and options.verify:
+        if options.dedupe is not None:
+            print('ERROR: --dedupe drops entries from the new feed and needs a --new/-n file argument')
+            sys.exit(1)
+        verify_feed(options)
+    append_feed(parser, options)
+
+def merge_main(argv):
+    parser = _command_parser('merge', '%(prog)s -n NEW_FILE [options] FEED [FEED ...]',
+                             'Merge feeds with differing headers into one sorted feed.')
+    parser.add_argument('feeds', nargs='*', metavar='FEED')
+    parser.add_argument('-n', '--new',     dest='new_file',
+                        help='File to write the merged feed to, compressed by a .gz/.bz2/.xz extension (- for stdout)')
+    parser.add_argument('--drop-invalid',  dest='drop_invalid', action='store_true', default=False,
+                        help='Leave bad entries out of the merged feed instead of stopping at the first one')
+    parser.add_argument('--fill',          dest='fill', action='append', metavar='COLUMN=VALUE',
+                        help='Value for COLUMN in feeds that lack it (default: -)')
+    parser.add_argument('--sort-buffer',   dest='sort_buffer', type=int, default=64,
+                        help='Megabytes of entries to sort in memory before spilling to disk')
+    parser.add_argument('--tmp-dir',       dest='tmp_dir',
+                        help='Directory for sort spill files')
+    parser.add_argument('--public-suffix-list', dest='public_suffix_list',
+                        help='Also check Intel::DOMAIN entries against this public suffix list')
+    parser.add_argument('--normalize-domains', dest='normalize_domains', action='store_true', default=False,
+                        help='Lowercase Intel::DOMAIN and Intel::URL hosts, strip trailing dots and convert IDNs to punycode')
+    parser.add_argument('--normalize-hashes', dest='normalize_hashes', action='store_true', default=False,
+                        help='Lowercase Intel::FILE_HASH and Intel::CERT_HASH values and strip fingerprint colons')
+    parser.add_argument('--allowlist',     dest='allowlist', action='append', metavar='FILE',
+                        help='Flag or drop entries whose indicator is listed in FILE, compiled once to FILE%s' % (ALLOWLIST_SUFFIX))
+    parser.add_argument('--allowlist-action', dest='allowlist_action',
+                        choices=bro_intel_feed_verifier.allowlist_actions, default='flag',
+                        help='What to do with allowlisted entries: flag (warn) or drop')
+    options = parser.parse_args(argv)
+
+    if options.new_file is None or not options.feeds:
+        parser.print_help()
+        sys.exit(1)
+
+    for feed in options.feeds:
+        if not os.path.exists(feed):
+            print('ERROR: Feed file not found - %s' % (feed))
+            sys.exit(1)
+
+    bro_intel_feed_merger(options, options.feeds).merge()
+
+def diff_main(argv):
+    parser = _command_parser('diff', '%(prog)s [--added FILE] [--removed FILE] [--modified FILE] OLD_FEED NEW_FEED',
+                             'Write the entries added, removed and modified between two feeds.')
+    parser.add_argument('feeds', nargs='*', metavar='FEED')
+    parser.add_argument('--added',         dest='added_file',
+                        help='File to write entries only in NEW_FEED to (- for stdout)')
+    parser.add_argument('--removed',       dest='removed_file',
+                        help='File to write entries only in OLD_FEED to (- for stdout)')
+    parser.add_argument('--modified',      dest='modified_file',
+                        help='File to write entries of NEW_FEED that differ from OLD_FEED to (- for stdout)')
+    parser.add_argument('--drop-invalid',  dest='drop_invalid', action='store_true', default=False,
+                        help='Leave bad entries out of the comparison instead of stopping at the first one')
+    parser.add_argument('--sort-buffer',   dest='sort_buffer', type=int, default=64,
+                        help='Megabytes of entries per feed to sort in memory before spilling to disk')
+    parser.add_argument('--tmp-dir',       dest='tmp_dir',
+                        help='Directory for sort spill files')
+    parser.add_argument('--public-suffix-list', dest='public_suffix_list',
+                        help='Also check Intel::DOMAIN entries against this public suffix list')
+    parser.add_argument('--normalize-domains', dest='normalize_domains', action='store_true', default=False,
+                        help='Lowercase Intel::DOMAIN and Intel::URL hosts, strip trailing dots and convert IDNs to punycode')
+    parser.add_argument('--normalize-hashes', dest='normalize_hashes', action='store_true', default=False,
+                        help='Lowercase Intel::FILE_HASH and Intel::CERT_HASH values and strip fingerprint colons')
+    options = parser.parse_args(argv)
+
+    if len(options.feeds) != 2 or (options.added_file is None and options.removed_file is None and
+                                   options.modified_file is None):
+        parser.print_help()
+        sys.exit(1)
+
+    for feed in options.feeds:
+        if not os.path.exists(feed):
+            print('ERROR: Feed file not found - %s' % (feed))
+            sys.exit(1)
+
+    bro_intel_feed_differ(options, options.feeds[0], options.feeds[1]).diff()
+
+def stats_main(argv):
+    parser = _command_parser('stats', '%(prog)s [--format table|json] FEED',
+                             'Count the entries of a feed per indicator type and source.')
+    parser.add_argument('feed', metavar='FEED',
+                        help='Bro Intel Feed, optionally gzip/bzip2/xz compressed (- for stdin)')
+    parser.add_argument('--format',        dest='format',
+                        choices=bro_intel_feed_stats.formats, default='table',
+                        help='Report format: table or json')
+    options = parser.parse_args(argv)
+
+    if options.feed != STDIO_NAME and not os.path.exists(options.feed):
+        print('ERROR: Feed file not found - %s' % (options.feed))
+        sys.exit(1)
+
+    bro_intel_feed_stats(options.feed).collect().report(sys.stdout, options.format)
+
+def export_main(argv):
+    parser = _command_parser('export', '%(prog)s [-n FILE] COMPILED_FEED',
+                             'Write a compiled feed back out as a Bro Intel feed.')
+    parser.add_argument('compiled_file', metavar='COMPILED_FEED')
+    parser.add_argument('-n', '--new',     dest='new_file', default=STDIO_NAME,
+                        help='File to write the feed to, compressed by a .gz/.bz2/.xz extension (default: stdout)')
+    options = parser.parse_args(argv)
+
+    try:
+        compiled = bro_intel_compiled_feed(options.compiled_file)
+    except (IOError, OSError, ValueError, struct.error) as e:
+        write_stderr('ERROR: Unable to load compiled feed - %s' % (e))
+        sys.exit(1)
+
+    out = bro_intel_shard_writer(options.new_file, compiled.header + b'\n')
+    try:
+        for lines in compiled.tsv_blocks():
+            out.write(lines)
+    except BaseException:
+        out.discard()
+        raise
+    finally:
+        compiled.close()
+    out.close()
+
+def serve_main(argv):
+    parser = _command_parser('serve', '%(prog)s --socket PATH',
+                             'Verify feeds sent over a Unix domain socket.')
+    parser.add_argument('--socket',        dest='socket_path', help='Unix domain socket to listen on')
+    parser.add_argument('--tmp-dir',       dest='tmp_dir',
+                        help='Directory for feeds streamed to the daemon')
+    parser.add_argument('--public-suffix-list', dest='public_suffix_list',
+                        help='Also check Intel::DOMAIN entries against this public suffix list')
+    options = parser.parse_args(argv)
+
+    if options.socket_path is None:
+        parser.print_help()
+        sys.exit(1)
+
+    server_class = _define_verify_daemon()
+    if not server_class.remove_stale_socket(options.socket_path):
+        write_stderr('ERROR: A daemon is already listening on %s' % (options.socket_path))
+        sys.exit(1)
+
+    server = server_class(options.socket_path, options.tmp_dir, options.public_suffix_list)
+    for s in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(s, lambda signum, frame: server.request_shutdown())
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(options.socket_path)
+
+COMMANDS = {'verify': verify_main,
+            'append': append_main,
+            'merge': merge_main,
+            'diff': diff_main,
+            'stats': stats_main,
+            'export': export_main,
+            'serve': serve_main}
+
+###############################################################################
+# main()
+###############################################################################
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
 
-                if options.meta_severity is not None:
-                    t_out += '\t' + str(options.meta_severity)
+    # Feed bytes quoted in messages are written out as they were read
+    for f in (sys.stdout, sys.stderr):
+        if isinstance(f, io.TextIOWrapper):
+            f.reconfigure(encoding='utf-8', errors='surrogateescape')
 
-            new_out.write(t_out + '\n')
-        new_out.close()
+    header_only_main(argv)
+    if argv and argv[0] in COMMANDS:
+        return COMMANDS[argv[0]](argv[1:])
+    return legacy_main(argv)
 
 ###############################################################################
 # __name__ checking
@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+#
+# Benchmark harness for the PacketSled Intel Pre Processor (pipp.py)
+#
+# Generates a deterministic synthetic Bro Intel feed and times start up, the
+# header check, full verification, the append path and every indicator type
+# handler on its own. Results are written as JSON so runs can be compared
+# across changes.
+#
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import resource
+import argparse
+import tempfile
+import subprocess
+
+import pipp
+
+
+###############################################################################
+# class bro_intel_feed_generator
+#
+# Deterministic synthetic feed generator. The same seed, size, mix, meta
+# columns and bad row rate always produce the same feed.
+#
+class bro_intel_feed_generator:
+    INDICATOR_TYPES = ['Intel::ADDR',
+                       'Intel::NET',
+                       'Intel::URL',
+                       'Intel::SOFTWARE',
+                       'Intel::EMAIL',
+                       'Intel::DOMAIN',
+                       'Intel::USER_NAME',
+                       'Intel::FILE_HASH',
+                       'Intel::FILE_NAME',
+                       'Intel::CERT_HASH']
+
+    META_FIELDS = ['meta.desc',
+                   'meta.do_notice',
+                   'meta.if_in',
+                   'meta.url',
+                   'meta.whitelist',
+                   'meta.severity',
+                   'meta.cif_confidence',
+                   'meta.cif_severity',
+                   'meta.cif_impact']
+
+    def __init__(self, seed=0, mix=None, meta_fields=None, bad_rate=0.0):
+        self.seed = seed
+        self.mix = mix or dict((t, 1) for t in self.INDICATOR_TYPES)
+        self.meta_fields = self.META_FIELDS if meta_fields is None else meta_fields
+        self.bad_rate = bad_rate
+        self.fields = ['indicator', 'indicator_type', 'meta.source'] + list(self.meta_fields)
+        self.__types = sorted(self.mix)
+        self.__weights = [self.mix[t] for t in self.__types]
+        self.__indicator = {'Intel::ADDR':      self.__addr,
+                            'Intel::NET':       self.__net,
+                            'Intel::URL':       self.__url,
+                            'Intel::SOFTWARE':  self.__software,
+                            'Intel::EMAIL':     self.__email,
+                            'Intel::DOMAIN':    self.__domain,
+                            'Intel::USER_NAME': self.__user_name,
+                            'Intel::FILE_HASH': self.__file_hash,
+                            'Intel::FILE_NAME': self.__file_name,
+                            'Intel::CERT_HASH': self.__cert_hash}
+        self.__if_in = sorted(pipp.as_text(t) for t in pipp.bro_data_intel_field_values.META_IF_IN)
+        self.__meta = {'meta.source':         lambda r: 'source%d' % (r.randint(0, 31)),
+                       'meta.desc':           lambda r: 'synthetic entry %d' % (r.randint(0, 9999)),
+                       'meta.do_notice':      lambda r: r.choice('TF'),
+                       'meta.if_in':          lambda r: r.choice(self.__if_in),
+                       'meta.url':            lambda r: 'http://intel.example.com/ref/%d' % (r.randint(0, 99999)),
+                       'meta.whitelist':      lambda r: '-',
+                       'meta.severity':       lambda r: str(r.randint(1, 10)),
+                       'meta.cif_confidence': lambda r: str(r.randint(1, 100)),
+                       'meta.cif_severity':   lambda r: r.choice(['low', 'medium', 'high']),
+                       'meta.cif_impact':     lambda r: r.choice(['botnet', 'malware', 'scanner'])}
+
+    def __addr(self, r):
+        if r.random() < 0.1:
+            return '2001:db8:%x::%x' % (r.getrandbits(16), r.getrandbits(16))
+        return '%d.%d.%d.%d' % (r.randint(1, 223), r.randint(0, 255), r.randint(0, 255), r.randint(1, 254))
+
+    def __net(self, r):
+        return '%d.%d.0.0/16' % (r.randint(1, 223), r.randint(0, 255))
+
+    def __url(self, r):
+        return 'www.example%d.com/path/%d?id=%d' % (r.randint(0, 9999), r.randint(0, 999), r.randint(0, 99999))
+
+    def __software(self, r):
+        return 'Agent/%d.%d' % (r.randint(1, 9), r.randint(0, 99))
+
+    def __email(self, r):
+        return 'user%d@example%d.com' % (r.randint(0, 99999), r.randint(0, 999))
+
+    def __domain(self, r):
+        return 'host%d.example%d.com' % (r.randint(0, 99999), r.randint(0, 999))
+
+    def __user_name(self, r):
+        return 'user%d' % (r.randint(0, 99999))
+
+    def __file_hash(self, r):
+        return ('%064x' % (r.getrandbits(256)))[:r.choice([32, 40, 64])]
+
+    def __file_name(self, r):
+        return 'file%d.exe' % (r.randint(0, 99999))
+
+    def __cert_hash(self, r):
+        return '%040x' % (r.getrandbits(160))
+
+    def __choose_type(self, r):
+        x = r.random() * sum(self.__weights)
+        for t, w in zip(self.__types, self.__weights):
+            x -= w
+            if x < 0:
+                return t
+        return self.__types[-1]
+
+    def indicators(self, indicator_type, count):
+        r = random.Random('%s-%s' % (self.seed, indicator_type))
+        return [self.__indicator[indicator_type](r) for i in range(count)]
+
+    def header(self):
+        return '\t'.join([pipp.bro_intel_feed_verifier.field_header_designator] + self.fields)
+
+    ##
+    # Produce one row. Bad rows are broken in one of a few ways: a missing
+    # column, an indicator that does not match its type, or a non-printable
+    # byte.
+    ##
+    def row(self, r):
+        t = self.__choose_type(r)
+        values = [self.__indicator[t](r), t] + [self.__meta[k](r) for k in self.fields[2:]]
+        if self.bad_rate and r.random() < self.bad_rate:
+            kind = r.randint(0, 2)
+            if kind == 0:
+                values.pop()
+            elif kind == 1:
+                values[1] = 'Intel::ADDR' if t != 'Intel::ADDR' else 'Intel::NET'
+                values[0] = 'not-an-address'
+            else:
+                values[0] = values[0][:1] + '\x07' + values[0][1:]
+        return '\t'.join(values)
+
+    def write(self, path, rows):
+        r = random.Random(self.seed)
+        with open(path, 'w') as f:
+            f.write(self.header() + '\n')
+            batch = []
+            for i in range(rows):
+                batch.append(self.row(r))
+                if len(batch) == 10000:
+                    f.write('\n'.join(batch) + '\n')
+                    batch = []
+            if batch:
+                f.write('\n'.join(batch) + '\n')
+
+
+###############################################################################
+# Measurement helpers
+###############################################################################
+class _bench_options:
+    def __init__(self, **kwargs):
+        self.feed_file = None
+        self.new_file = None
+        self.meta_desc = None
+        self.meta_severity = None
+        self.reject_file = None
+        self.__dict__.update(kwargs)
+
+
+##
+# Run func in a forked child with stderr discarded, so every phase starts from
+# the same state and reports its own peak RSS. Returns a dict with the wall
+# time, the peak RSS in KiB and the exit status (non-zero if the phase called
+# sys.exit() with a failure).
+##
+def run_isolated(func):
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(rfd)
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, 2)
+        status = 0
+        start = time.time()
+        try:
+            func()
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else 1
+        elapsed = time.time() - start
+        result = {'seconds': elapsed,
+                  'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                  'exit_status': status}
+        os.write(wfd, json.dumps(result).encode('ascii'))
+        os._exit(0)
+
+    os.close(wfd)
+    data = b''
+    while True:
+        chunk = os.read(rfd, 65536)
+        if not chunk:
+            break
+        data += chunk
+    os.close(rfd)
+    os.waitpid(pid, 0)
+    return json.loads(data.decode('ascii'))
+
+
+def time_handlers(generator, calls):
+    biit = pipp.bro_intel_indicator_type()
+    out = {}
+    for t in generator.INDICATOR_TYPES:
+        indicators = [i.encode('ascii') for i in generator.indicators(t, calls)]
+        h = biit.get_handler(t.encode('ascii'))
+        start = time.time()
+        for i in indicators:
+            h(i)
+        elapsed = time.time() - start
+        out[t] = {'calls': calls,
+                  'seconds': elapsed,
+                  'ns_per_call': elapsed / calls * 1e9}
+    return out
+
+
+##
+# Time whole runs of short command lines, each in a fresh interpreter, where
+# start up is most of the cost: the interpreter alone, the header check run
+# through the pipp launcher (cached bytecode) and as the pipp.py script, and
+# the header check with every lazily imported module imported up front, as
+# before imports were lazy. Every command is run once untimed to warm the
+# page and bytecode caches.
+##
+def time_startup(feed, runs):
+    here = os.path.dirname(os.path.abspath(pipp.__file__))
+    header_only = ['verify', '--header-only', feed]
+    eager = ('import importlib, pipp\n'
+             'for m in pipp.LAZY_MODULES:\n'
+             '    importlib.import_module(m)\n'
+             'pipp.main()\n')
+    commands = {'interpreter': [sys.executable, '-c', 'pass'],
+                'header_only': [sys.executable, os.path.join(here, 'pipp')] + header_only,
+                'header_only_script': [sys.executable, os.path.join(here, 'pipp.py')] + header_only,
+                'header_only_eager_imports': [sys.executable, '-c', eager] + header_only}
+    env = dict(os.environ, PYTHONPATH=here)
+
+    out = {}
+    with open(os.devnull, 'w') as devnull:
+        for name, command in sorted(commands.items()):
+            times = []
+            for i in range(runs + 1):
+                start = time.time()
+                status = subprocess.call(command, stdout=devnull, stderr=devnull, env=env)
+                times.append(time.time() - start)
+            out[name] = {'runs': runs,
+                         'seconds': sum(times[1:]) / runs,
+                         'min_seconds': min(times[1:]),
+                         'exit_status': status}
+    return out
+
+
+def run_benchmarks(options, workdir):
+    mix = None
+    if options.mix:
+        mix = {}
+        for item in options.mix.split(','):
+            t, sep, w = item.partition('=')
+            mix[t] = float(w) if sep else 1.0
+    meta_fields = None
+    if options.meta is not None:
+        meta_fields = [k for k in options.meta.split(',') if k]
+
+    generator = bro_intel_feed_generator(options.seed, mix, meta_fields, options.bad_rate)
+    feed = os.path.join(workdir, 'feed.dat')
+    start = time.time()
+    generator.write(feed, options.rows)
+    generate_seconds = time.time() - start
+
+    phases = {
+        'header': lambda: pipp.bro_intel_feed_verifier(
+            _bench_options(feed_file=feed)).verify(header_only=True),
+        'verify': lambda: pipp.bro_intel_feed_verifier(
+            _bench_options(feed_file=feed)).verify(),
+        'verify_columnar': lambda: pipp.bro_intel_feed_verifier(
+            _bench_options(feed_file=feed, columnar=True)).verify(),
+        'verify_parallel': lambda: pipp.bro_intel_feed_verifier(
+            _bench_options(feed_file=feed)).verify(jobs=options.jobs),
+        'append': lambda: pipp.populate_existing_bro_feed(
+            _bench_options(feed_file=feed,
+                           new_file=os.path.join(workdir, 'new.dat'),
+                           reject_file=os.path.join(workdir, 'reject.dat'),
+                           meta_desc=None if 'meta.desc' in generator.fields else 'synthetic',
+                           meta_severity=None if 'meta.severity' in generator.fields else 5)),
+    }
+
+    report = {'python': sys.version.split()[0],
+              'rows': options.rows,
+              'seed': options.seed,
+              'bad_rate': options.bad_rate,
+              'fields': generator.fields,
+              'feed_bytes': os.path.getsize(feed),
+              'generate_seconds': generate_seconds,
+              'phases': {},
+              'handlers': {},
+              'startup': {}}
+
+    for name in [p for p in options.phases.split(',') if p]:
+        if name == 'handlers':
+            report['handlers'] = time_handlers(generator, options.handler_calls)
+            continue
+        if name == 'startup':
+            report['startup'] = time_startup(feed, options.startup_runs)
+            continue
+        if name not in phases:
+            pipp.write_stderr('Unknown phase - %s' % (name))
+            sys.exit(1)
+        result = run_isolated(phases[name])
+        rows = 1 if name == 'header' else options.rows
+        # A phase that stopped early did not process every row
+        result['rows_per_sec'] = None
+        if result['exit_status'] == 0 and result['seconds']:
+            result['rows_per_sec'] = rows / result['seconds']
+        report['phases'][name] = result
+    return report
+
+
+###############################################################################
+# main()
+###############################################################################
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r', '--rows',     dest='rows', type=int, default=100000,
+                        help='Number of entries in the synthetic feed')
+    parser.add_argument('-s', '--seed',     dest='seed', type=int, default=0,
+                        help='Generator seed')
+    parser.add_argument('--mix',            dest='mix',
+                        help='Indicator type weights, e.g. Intel::ADDR=5,Intel::DOMAIN=2 (default: even)')
+    parser.add_argument('--meta',           dest='meta',
+                        help='Comma separated optional meta columns (default: all)')
+    parser.add_argument('--bad-rate',       dest='bad_rate', type=float, default=0.0,
+                        help='Fraction of rows that are deliberately broken')
+    parser.add_argument('--phases',         dest='phases',
+                        default='startup,header,verify,verify_columnar,append,handlers',
+                        help='Comma separated phases: startup, header, verify, verify_columnar, '
+                             'verify_parallel, append, handlers')
+    parser.add_argument('-j', '--jobs',     dest='jobs', type=int, default=0,
+                        help='Processes for the verify_parallel phase (0 = all cores)')
+    parser.add_argument('--handler-calls',  dest='handler_calls', type=int, default=20000,
+                        help='Indicators timed per handler')
+    parser.add_argument('--startup-runs',   dest='startup_runs', type=int, default=10,
+                        help='Runs timed per command line in the startup phase')
+    parser.add_argument('-o', '--output',   dest='output',
+                        help='Write the JSON report here instead of stdout')
+    options = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='pipp_bench.')
+    try:
+        report = run_benchmarks(options, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    out = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(out + '\n')
+    else:
+        sys.stdout.write(out + '\n')
+
+###############################################################################
+# __name__ checking
+###############################################################################
+if __name__ == '__main__':
+    main()